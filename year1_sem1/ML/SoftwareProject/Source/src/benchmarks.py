@@ -0,0 +1,313 @@
+import time
+
+import numpy as np
+
+from dataloader import OccupancyEstimationDataloader
+from models.QP import QPSolver
+from models.decision_tree import DecisionTree
+from models.random_forest import RandomForest
+from models.svr_old import SVR, KernelProvider
+from preprocessor import DateAndTimePreprocessor
+
+DATASET_PATH = "../dataset/Occupancy_Estimation.csv"
+
+
+def _timeit(fun, repeat: int = 3):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fun()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _box_qp(n: int, seed: int = 0):
+    """Random SVR-like QP data: box constraints Ai=[I;-I] and one equality row"""
+    rng = np.random.default_rng(seed)
+    d = rng.random(n)
+    lam = rng.random(2 * n)
+    mu = rng.random(1)
+    B = np.eye(n)
+    df = rng.random(n)
+    Ai = np.concatenate([np.eye(n), -np.eye(n)], axis=0)
+    g = np.concatenate([np.zeros(n), np.ones(n)])
+    Ae = np.concatenate([np.ones(n // 2), -np.ones(n - n // 2)]).reshape((1, -1))
+    h = np.zeros(1)
+    return d, mu, lam, B, df, Ai, g, Ae, h
+
+
+def _loop_dah(ep, d, mu, lam, B, df, Ai, g, Ae, h):
+    # Per-constraint reference implementation of QPSolver.dah
+    dim_x, dim_mu, dim_lam = np.size(df), np.size(h), np.size(g)
+    dh = np.zeros(dim_x + dim_mu + dim_lam + 1)
+    dh[0] = ep
+    dh[1 : dim_x + 1] = (
+        np.matmul(B, d) - np.matmul(Ae.T, mu) - np.matmul(Ai.T, lam) + df
+    )
+    dh[dim_x + 1 : dim_x + dim_mu + 1] = h + np.matmul(Ae, d)
+    for i in range(dim_lam):
+        dh[dim_x + dim_mu + 1 + i] = QPSolver.phi(ep, lam[i], g[i] + np.sum(Ai[i] * d))
+    return dh
+
+
+def _loop_ddv(ep, d, lam, Ai, g):
+    # Per-constraint reference implementation of QPSolver.ddv with dense diagonal blocks
+    dim_lam = np.size(g)
+    dd1 = np.zeros((dim_lam, dim_lam))
+    dd2 = np.zeros((dim_lam, dim_lam))
+    v1 = np.zeros(dim_lam)
+    for i in range(dim_lam):
+        s = g[i] + np.sum(Ai[i] * d)
+        fm = pow(lam[i] ** 2 + s**2 + 2 * ep**2, 0.5)
+        dd1[i, i] = 1 - lam[i] / fm
+        dd2[i, i] = 1 - s / fm
+        v1[i] = -2 * ep / fm
+    return dd1, dd2, v1
+
+
+def benchmark_qp_residual(sizes=(1000, 5000, 10000), repeat: int = 3):
+    """Times one evaluation of H(z) and of its Phi-derivative, loop vs vectorized"""
+    ep = 0.05
+    for n in sizes:
+        d, mu, lam, B, df, Ai, g, Ae, h = _box_qp(n)
+        args = (ep, d, mu, lam, B, df, Ai, g, Ae, h)
+
+        t_loop = _timeit(lambda: _loop_dah(*args), repeat)
+        t_vec = _timeit(lambda: QPSolver.dah(*args), repeat)
+        print(
+            f"dah n={n}: loop={t_loop:.4f}s vectorized={t_vec:.4f}s speedup={t_loop / t_vec:.1f}x"
+        )
+
+        # the loop version allocates two dense (2n x 2n) blocks, skip it when they get too big
+        if n <= 5000:
+            t_loop = _timeit(lambda: _loop_ddv(ep, d, lam, Ai, g), repeat)
+        else:
+            t_loop = np.nan
+        t_vec = _timeit(lambda: QPSolver.ddv(ep, d, lam, Ai, g), repeat)
+        print(
+            f"ddv n={n}: loop={t_loop:.4f}s vectorized={t_vec:.4f}s speedup={t_loop / t_vec:.1f}x"
+        )
+
+
+def benchmark_qp_jacobian(sizes=(1000,), repeat: int = 3):
+    """Times assembling the full Jacobian of H(z), fresh allocation vs reused buffer"""
+    ep = 0.05
+    for n in sizes:
+        d, mu, lam, B, df, Ai, g, Ae, h = _box_qp(n)
+        args = (ep, d, mu, lam, B, df, Ai, g, Ae, h)
+        A = QPSolver.JacobiH(*args)
+
+        t_new = _timeit(lambda: QPSolver.JacobiH(*args), repeat)
+        t_buf = _timeit(lambda: QPSolver.JacobiH(*args, out=A), repeat)
+        print(f"JacobiH n={n}: allocated={t_new:.4f}s buffered={t_buf:.4f}s")
+
+
+def benchmark_qp_linsolve(sizes=(200, 500, 1000), repeat: int = 1):
+    """Times a full smoothing Newton solve, dense Jacobian vs Schur complement steps"""
+    for n in sizes:
+        _, _, _, _, df, Ai, g, Ae, h = _box_qp(n)
+        rng = np.random.default_rng(n)
+        B = rng.random((n, n))
+        B = B @ B.T / n + np.eye(n)
+        df = 2 * df - 1
+
+        t_dense = _timeit(
+            lambda: QPSolver.quadprog_smoothNewton(B, df, Ai, g, Ae, h), repeat
+        )
+        t_schur = _timeit(
+            lambda: QPSolver.quadprog_smoothNewton(
+                B, df, Ai, g, Ae, h, linsolve="schur"
+            ),
+            repeat,
+        )
+        print(
+            f"quadprog n={n}: dense={t_dense:.4f}s schur={t_schur:.4f}s speedup={t_dense / t_schur:.1f}x"
+        )
+
+
+def _loop_working_set(svr: SVR, alpha: np.ndarray, tmp_grads: np.ndarray):
+    # Per-index reference implementation of I_up, I_low and the second order selection of wss1
+    L, C, u, kp = svr.L, svr.C, svr.u, svr.kp
+    i_up = np.array(
+        [
+            t
+            for t in range(L)
+            if (alpha[t] < C and u[t] == 1) or (alpha[t] > 0 and u[t] == -1)
+        ]
+    )
+    i_low = np.array(
+        [
+            t
+            for t in range(L)
+            if (alpha[t] < C and u[t] == -1) or (alpha[t] > 0 and u[t] == 1)
+        ]
+    )
+    i = i_up[np.argmax(tmp_grads[i_up])]
+    a, b = np.zeros(L), np.zeros(L)
+    for t in range(L):
+        a[t] = kp.K(i, i) + kp.K(t, t) - 2 * kp.K(i, t)
+        if a[t] <= 0:
+            a[t] = svr.tol
+        b[t] = tmp_grads[i] - tmp_grads[t]
+    cand = [t for t in i_low if tmp_grads[t] < tmp_grads[i]]
+    values = np.array([-b[t] * b[t] / a[t] for t in cand])
+    return i, cand[np.argmin(values)]
+
+
+def _mask_working_set(svr: SVR, alpha: np.ndarray, tmp_grads: np.ndarray):
+    i_up = np.flatnonzero(svr.I_up(alpha))
+    i_low = np.flatnonzero(svr.I_low(alpha))
+    return svr.wss1(alpha, tmp_grads, i_up, i_low, -1, -1)
+
+
+def benchmark_working_set_selection(
+    sizes=(500, 2000, 5000), n_features: int = 20, repeat: int = 3
+):
+    """Working set selections per second for the SMO SVR, per-index loops vs boolean masks"""
+    for n in sizes:
+        rng = np.random.default_rng(n)
+        x = rng.random((n, n_features))
+        svr = SVR(kernel="poly", coef0=1)
+        svr.n, svr.L, svr.p = n, 2 * n, np.zeros(2 * n)
+        svr.u = np.concatenate((np.ones(n), -np.ones(n)))
+        svr.kp = KernelProvider(svr.phi, x, svr.u, svr.cache_size)
+        alpha = rng.choice([0.0, 0.5 * svr.C, svr.C], size=2 * n)
+        tmp_grads = rng.standard_normal(2 * n)
+
+        t_loop = _timeit(lambda: _loop_working_set(svr, alpha, tmp_grads), repeat)
+        t_mask = _timeit(lambda: _mask_working_set(svr, alpha, tmp_grads), repeat)
+        print(
+            f"wss n={n}: loop={1 / t_loop:.1f} it/s masks={1 / t_mask:.1f} it/s speedup={t_loop / t_mask:.1f}x"
+        )
+
+
+def _occupancy_arrays(dataset_path: str):
+    loader = OccupancyEstimationDataloader(
+        dataset_path, DateAndTimePreprocessor.process
+    )
+    X, y = loader.to_numpy(dtype=float)
+    return X, (y > 0).astype(int)
+
+
+class _LoopSplitDecisionTree(DecisionTree):
+    # Reference split search: every unique threshold of every feature, np.where + np.unique
+    @classmethod
+    def _node_impurity(cls, y: np.ndarray, method: str):
+        _, counts = np.unique(y, return_counts=True)
+        probabilities = counts / len(y)
+        if method == "gini":
+            return 1 - np.sum(probabilities**2)
+        return -np.sum(probabilities * np.log2(probabilities + 1e-9))
+
+    def _best_split(self, X: np.ndarray, y: np.ndarray, samples: np.ndarray):
+        X, y = X[samples], y[samples]
+        method = "gini" if self.impurity == self._gini else "entropy"
+        parent_impurity = self._node_impurity(y, method)
+        best_gain, best_split = -1, None
+        for feature_idx in range(X.shape[1]):
+            for threshold in np.unique(X[:, feature_idx]):
+                left_idx = np.where(X[:, feature_idx] <= threshold)[0]
+                right_idx = np.where(X[:, feature_idx] > threshold)[0]
+                if len(left_idx) == 0 or len(right_idx) == 0:
+                    continue
+                gain = parent_impurity - (
+                    len(left_idx) / len(y) * self._node_impurity(y[left_idx], method)
+                    + len(right_idx)
+                    / len(y)
+                    * self._node_impurity(y[right_idx], method)
+                )
+                if gain > best_gain:
+                    best_gain = gain
+                    best_split = {
+                        "feature_idx": feature_idx,
+                        "threshold": threshold,
+                        "cut": threshold,
+                        "gain": gain,
+                    }
+        return best_split
+
+
+def benchmark_decision_tree(
+    dataset_path: str = DATASET_PATH, max_depth: int = 5, max_bins=(None, 64, 16)
+):
+    """Decision tree fit time on the Occupancy data, per-threshold loop vs one pass per feature"""
+    X, y = _occupancy_arrays(dataset_path)
+    for method in ["gini", "entropy"]:
+        tree = _LoopSplitDecisionTree(method=method, max_depth=max_depth)
+        t_loop = _timeit(lambda: tree.fit(X, y), repeat=1)
+        print(f"tree {method} n={len(X)}: loop={t_loop:.3f}s")
+        for bins in max_bins:
+            tree = DecisionTree(method=method, max_depth=max_depth, max_bins=bins)
+            t_scan = _timeit(lambda: tree.fit(X, y), repeat=1)
+            accuracy = np.mean(tree.predict(X) == y)
+            print(
+                f"tree {method} n={len(X)} max_bins={bins}: {t_scan:.3f}s "
+                f"speedup={t_loop / t_scan:.1f}x train accuracy={accuracy:.4f}"
+            )
+
+
+def benchmark_dataloader(dataset_path: str = DATASET_PATH):
+    """Time to get the Occupancy arrays, per-row dict iteration vs columnar conversion"""
+    loader = OccupancyEstimationDataloader(
+        dataset_path, DateAndTimePreprocessor.process
+    )
+
+    def rows():
+        X = [[x[col] for col in loader.input_columns] for x, _ in loader]
+        return np.array(X)
+
+    t_rows = _timeit(rows, repeat=1)
+    t_cols = _timeit(lambda: loader.to_numpy(dtype=np.float32))
+    same = np.array_equal(rows(), loader.to_numpy(dtype=float)[0])
+    print(
+        f"dataloader n={len(loader)}: rows={t_rows:.3f}s columns={t_cols:.5f}s "
+        f"speedup={t_rows / t_cols:.1f}x same values={same}"
+    )
+
+
+def _loop_forest_predict(rf: RandomForest, X: np.ndarray):
+    # Per-row reference: every tree walked for every row, one bincount per row
+    return np.array(
+        [
+            np.bincount(
+                [
+                    tree.predict_one(x[feature_indices])
+                    for tree, feature_indices in rf.trees
+                ]
+            ).argmax()
+            for x in X
+        ]
+    )
+
+
+def benchmark_random_forest_predict(
+    dataset_path: str = DATASET_PATH, n_estimators: int = 20, max_depth: int = 5
+):
+    """Random forest inference time on the Occupancy data, per-row voting vs batch voting"""
+    X, y = _occupancy_arrays(dataset_path)
+    rf = RandomForest(n_estimators=n_estimators, max_depth=max_depth, random_state=0)
+    rf.fit(X, y)
+    t_loop = _timeit(lambda: _loop_forest_predict(rf, X), repeat=1)
+    t_batch = _timeit(lambda: rf.predict(X))
+    same = np.array_equal(_loop_forest_predict(rf, X), rf.predict(X))
+    print(
+        f"forest predict n={len(X)} trees={n_estimators}: loop={t_loop:.3f}s "
+        f"batch={t_batch:.4f}s speedup={t_loop / t_batch:.1f}x same predictions={same}"
+    )
+
+
+if __name__ == "__main__":
+    print("===== Benchmark QP residual =====")
+    benchmark_qp_residual()
+    print("===== Benchmark QP Jacobian =====")
+    benchmark_qp_jacobian()
+    print("===== Benchmark QP linear solve =====")
+    benchmark_qp_linsolve()
+    print("===== Benchmark SVR working set selection =====")
+    benchmark_working_set_selection()
+    print("===== Benchmark decision tree fit =====")
+    benchmark_decision_tree()
+    print("===== Benchmark random forest predict =====")
+    benchmark_random_forest_predict()
+    print("===== Benchmark dataloader =====")
+    benchmark_dataloader()
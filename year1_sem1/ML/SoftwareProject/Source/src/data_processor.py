@@ -1,33 +1,19 @@
-import csv, matplotlib.pyplot as plt, numpy as np, pandas as pd, scipy
+import matplotlib.pyplot as plt, numpy as np, pandas as pd, scipy
+from dataloader import OccupancyEstimationDataloader
+from preprocessor import DateAndTimePreprocessor
 
 dates = ['2018/01/11', '2017/12/24', '2017/12/26', '2018/01/10', '2017/12/22', '2017/12/23', '2017/12/25']
 
-def cvt_time(t):
-    h, m, s = t[0], t[1], t[2]
-    if h<6: return 1
-    if h<9: return 2
-    if h<12: return 3
-    if h<14: return 4
-    if h<17: return 5
-    if h<19: return 6
-    if h<22: return 7
-    return 8
-    # _[2]+_[1]*60+_[0]*3600 
-
 def load_data(path):    
-    with open(path, 'r') as f:
-        data = []
-        reader = csv.DictReader(f)
-        for line in reader:
-            line['Date'] = dates.index(line['Date'])
-            line['Time'] = [cvt_time(_) for _ in [list(map(int,line['Time'].split(':')))]][0]
-            for key in line:
-                if key!="Date" and key!="Time":
-                    line[key]=float(line[key])
-            if line['Room_Occupancy_Count']>0:
-                data.append(line)
-            #print(line)
-        return data
+    df = OccupancyEstimationDataloader.read_csv(path, float_dtype="float64")
+    df = df[df['Room_Occupancy_Count']>0]
+    hours = df['Time'].str.split(':', n=1).str[0].astype(int)
+    columns = {
+        'Date': df['Date'].map({ date:dates.index(date) for date in df['Date'].cat.categories }).astype(int),
+        'Time': np.searchsorted(DateAndTimePreprocessor._TIMES_DIVISIONS, hours, side='right') + 1, # 1 + number of divisions <= hour
+        'Room_Occupancy_Count': df['Room_Occupancy_Count'].astype(float),
+    }
+    return df.assign(**columns).to_dict('records')
         
 raw_data = load_data('Occupancy_Estimation.csv')
 
@@ -68,12 +54,21 @@ def panda_corr():
     print(data.shape)
     
 
+def to_matrix(data, labels):
+    # one row per sample, one column per label (nan for the string columns), and the numeric columns mask
+    numeric = np.array([ not isinstance(data[0][label], str) for label in labels ])
+    df = pd.DataFrame.from_records(data, columns=labels)
+    X = np.full((len(data), len(labels)), np.nan)
+    X[:, numeric] = df.loc[:, numeric].to_numpy(dtype=float)
+    return X, numeric
+
 def correlation_matrix(data, labels, label_to_index):
-    M = np.zeros((len(labels), len(labels)))
-    for i in range(len(labels)):
-        for j in range(i+1, len(labels)):
-            if not isinstance(data[0][labels[i]], str) and not isinstance(data[0][labels[j]], str):
-                M[j,i] = correlation_coeff(data, select_by_key(labels[i]), select_by_key(labels[j]))
+    # same as correlation_coeff for every pair below the diagonal, from one standardized X.T @ X
+    X, numeric = to_matrix(data, labels)
+    Z = (X - np.mean(X, axis=0)) / np.std(X, axis=0)
+    M = np.tril(Z.T @ Z / len(X), k=-1)
+    M[~numeric, :] = 0
+    M[:, ~numeric] = 0
     return M
 
 def plot_mat(M, labels, export_file):
@@ -131,12 +126,24 @@ def chi2_test(data, selector1, selector2):
     
     return 1-scipy.stats.chi2.cdf(X2, deg_freedom)
     
+def contingency_table(cx, nx, cy, ny):
+    # cx, cy: class codes in [0, nx), [0, ny) of the same samples
+    return np.bincount(cx*ny + cy, minlength=nx*ny).reshape((nx, ny))
+
 def indep_matrix(data, labels, label_to_index):
+    # same as chi2_test for every pair, with the classes of every column coded once
+    X, numeric = to_matrix(data, labels)
+    codes = {}
+    for i in np.flatnonzero(numeric):
+        classes, codes[i] = np.unique(X[:, i].astype(int), return_inverse=True)
+        codes[i] = (codes[i], len(classes))
+        
     M = np.zeros((len(labels), len(labels)))
-    for i in range(len(labels)):
-        for j in range(len(labels)):
-            if not isinstance(data[0][labels[i]], str) and not isinstance(data[0][labels[j]], str):
-                M[j,i] = chi2_test(data, select_by_key(labels[i]), select_by_key(labels[j]))
+    for i in codes:
+        for j in codes:
+            # the p-value of the transposed table is the same
+            if j < i: continue
+            M[j,i] = M[i,j] = scipy.stats.chi2_contingency(contingency_table(*codes[i], *codes[j])).pvalue
     return M
     
 ind_mat = indep_matrix(raw_data, labels, label_to_index); plot_mat(ind_mat, labels, "ind_mat.png")
@@ -1,15 +1,116 @@
+import hashlib
+import json
+import os
+
+import numpy as np
 import pandas as pd
 
 
 class OccupancyEstimationDataloader:
     _TARGET_COLUMN = "Room_Occupancy_Count"
+    _DATE_COLUMN = "Date"
+    _TIME_COLUMN = "Time"
 
-    def __init__(self, path: str, transform: callable = lambda x: x):
-        self.dataframe = transform(pd.read_csv(path))
+    def __init__(
+        self,
+        path: str,
+        transform: callable = lambda x: x,
+        compact_dtypes: bool = False,
+    ):
+        """compact_dtypes: read the CSV with the dtypes of csv_dtypes instead of the inferred ones"""
+        if compact_dtypes:
+            self.dataframe = transform(self.read_csv(path))
+        else:
+            self.dataframe = transform(pd.read_csv(path))
         self.input_columns = [
             column for column in self.dataframe.columns if column != self._TARGET_COLUMN
         ]
-        self.output_column = self._TARGET_COLUMN        
+        self.output_column = self._TARGET_COLUMN
+
+    @classmethod
+    def csv_dtypes(cls, path: str, float_dtype="float32"):
+        """Explicit dtypes of the CSV columns: categorical Date, string Time, int8 target,
+        float_dtype for the sensor readings"""
+        columns = pd.read_csv(path, nrows=0).columns
+        dtypes = {column: float_dtype for column in columns}
+        dtypes.update(
+            {
+                cls._DATE_COLUMN: "category",
+                cls._TIME_COLUMN: str,
+                cls._TARGET_COLUMN: "int8",
+            }
+        )
+        return dtypes
+
+    @classmethod
+    def read_csv(cls, path: str, chunksize: int | None = None, float_dtype="float32"):
+        """pd.read_csv with csv_dtypes, an iterator of DataFrames if chunksize is set"""
+        return pd.read_csv(
+            path, dtype=cls.csv_dtypes(path, float_dtype), chunksize=chunksize
+        )
+
+    @classmethod
+    def _file_hash(cls, path: str):
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @classmethod
+    def load_arrays(
+        cls,
+        path: str,
+        processor: type,
+        cache_dir: str | None = None,
+        chunksize: int = 100_000,
+        dtype=np.float32,
+    ):
+        """Processed feature matrix, target vector and input columns of the CSV file.
+        The CSV is streamed through processor.process_chunks once, the result is saved as
+        .npy files keyed by the file hash (in cache_dir, default: .cache next to the CSV)
+        and memory-mapped by the later calls"""
+        cache_dir = cache_dir or os.path.join(os.path.dirname(path), ".cache")
+        key = hashlib.sha256(
+            f"{cls._file_hash(path)} {processor.__qualname__} {np.dtype(dtype)}".encode()
+        ).hexdigest()[:16]
+        stem = os.path.join(cache_dir, f"{os.path.basename(path)}.{key}")
+
+        if not os.path.exists(f"{stem}.columns.json"):
+            Xs, ys, columns = [], [], None
+            for chunk in processor.process_chunks(
+                path, chunksize, dtype=cls.csv_dtypes(path, np.dtype(dtype).name)
+            ):
+                columns = [c for c in chunk.columns if c != cls._TARGET_COLUMN]
+                Xs.append(chunk[columns].to_numpy(dtype=dtype))
+                ys.append(chunk[cls._TARGET_COLUMN].to_numpy(dtype=np.int8))
+            os.makedirs(cache_dir, exist_ok=True)
+            np.save(f"{stem}.X.npy", np.concatenate(Xs))
+            np.save(f"{stem}.y.npy", np.concatenate(ys))
+            # written last, marks a complete entry
+            with open(f"{stem}.columns.json", "w") as f:
+                json.dump(columns, f)
+
+        with open(f"{stem}.columns.json") as f:
+            columns = json.load(f)
+        X = np.load(f"{stem}.X.npy", mmap_mode="r")
+        y = np.load(f"{stem}.y.npy", mmap_mode="r")
+        return X, y, columns
+
+    def to_numpy(self, dtype=None, target_dtype=None):
+        """Feature matrix (input_columns order) and target vector, one conversion per column block"""
+        X = self.dataframe[self.input_columns].to_numpy(dtype=dtype)
+        y = self.dataframe[self.output_column].to_numpy(dtype=target_dtype)
+        return X, y
+
+    def iter_batches(self, batch_size: int = 1024, dtype=None, target_dtype=None):
+        """Yields (X, y) blocks of at most batch_size rows, like to_numpy"""
+        for start in range(0, len(self.dataframe), batch_size):
+            batch = self.dataframe.iloc[start : start + batch_size]
+            yield (
+                batch[self.input_columns].to_numpy(dtype=dtype),
+                batch[self.output_column].to_numpy(dtype=target_dtype),
+            )
 
     def __getitem__(self, idx: int):
         row = self.dataframe.iloc[idx]
@@ -18,8 +119,8 @@ class OccupancyEstimationDataloader:
         row_output = row[self.output_column]
 
         return row_input, row_output
-        
-    def __iter__(self):        
+
+    def __iter__(self):
         for i in range(self.dataframe.shape[0]):
             yield self.__getitem__(i)
 
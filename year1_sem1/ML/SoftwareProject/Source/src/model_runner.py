@@ -1,6 +1,8 @@
 from dataloader import OccupancyEstimationDataloader
 from preprocessor import DateAndTimePreprocessor
 import numpy as np, scipy.stats as st
+import hashlib, inspect, io, itertools, json, math, os, sqlite3, tempfile
+from models.parallel import n_workers, worker_data, worker_pool
 import shap
 
 class CrossValidation:
@@ -75,24 +77,58 @@ class HyperParameters:
    
 
 class MetricEstimate:
-    def __init__(self, values):
-        self.values = np.array(values)
-        self.mean = np.mean(self.values)
-        self.std = np.std(self.values)
-        self.conf_interval = st.t.interval(0.95, len(self.values)-1, loc=self.mean, scale=st.sem(self.values))
+    # streaming mean and variance of a metric (Welford), the values themselves are not kept
+    def __init__(self, values=()):
+        self.count = 0
+        self._mean = 0.0
+        self._m2 = 0.0 # sum of squared deviations from the mean
+        for value in values: self.add(value)
+    
+    def add(self, value):
+        self.count += 1
+        delta = value - self._mean
+        self._mean += delta / self.count
+        self._m2 += delta * (value - self._mean)
+        return self
+    
+    def merge(self, other:'MetricEstimate'):
+        # combines the estimates of two disjoint sets of values (e.g. from two workers)
+        if other.count == 0: return self
+        count = self.count + other.count
+        delta = other._mean - self._mean
+        self._m2 += other._m2 + delta**2 * self.count * other.count / count
+        self._mean += delta * other.count / count
+        self.count = count
+        return self
+    
+    @property
+    def mean(self): return self._mean if self.count > 0 else np.nan
+    
+    @property
+    def std(self): return np.sqrt(self._m2 / self.count) if self.count > 0 else np.nan
+    
+    @property
+    def conf_interval(self):
+        if self.count < 2: # e.g. a single out of bag estimate
+            return (np.nan, np.nan)
+        sem = np.sqrt(self._m2 / (self.count - 1) / self.count)
+        return st.t.interval(0.95, self.count-1, loc=self._mean, scale=sem)
 
     def __repr__(self):
         return f"{{ mean={self.mean}, std={self.std}, conf_interval={self.conf_interval} }}"
         
 class PredictionMetrics:
-    def __init__(self, metrics:dict[str, callable], best_measure:tuple[str,str]):
+    def __init__(self, metrics:dict[str, callable], best_measure:tuple[str,str], prepare=None):
+        # prepare: if set, computed once per (y_true, y_pred) and passed to every metric instead of them
         self.metrics = metrics
         self.best_measure = best_measure
+        self.prepare = prepare
         
     def keys(self): return self.metrics.keys()
         
     def apply(self, y_true, y_pred):
-        return { name : fun(y_true, y_pred) for name, fun in self.metrics.items() }
+        args = (y_true, y_pred) if self.prepare is None else (self.prepare(y_true, y_pred),)
+        return { name : fun(*args) for name, fun in self.metrics.items() }
         
     def is_better(self, old_m:dict[str, MetricEstimate]|None, new_m:dict[str, MetricEstimate])->bool:
         if old_m is None: return True
@@ -113,75 +149,247 @@ class PredictionMetrics:
             'nrmse' : lambda y_true, y_pred: np.sqrt(np.sum(np.square(y_true-y_pred)) / np.sum(np.square(y_true))),
             'r2' : lambda y_true, y_pred: 1 -  np.sum(np.square(y_true-y_pred)) / np.sum(np.square(y_true-np.mean(y_true)))
         }, best_measure = ('r2', 'max'))
-        
+    
+    @staticmethod
+    def confusion_matrix(y_true, y_pred):
+        # C[t, p] = number of samples of class t predicted as p (at least the 2 classes 0 and 1)
+        y_true, y_pred = np.asarray(y_true), np.asarray(y_pred)
+        for y in (y_true, y_pred):
+            if not np.array_equal(y, y.astype(int)): raise ValueError(f"Invalid class labels: {np.unique(y)}, must be integers")
+        y_true, y_pred = y_true.astype(int), y_pred.astype(int)
+        k = max(2, np.max(y_true, initial=0)+1, np.max(y_pred, initial=0)+1)
+        return np.bincount(y_true*k + y_pred, minlength=k*k).reshape((k, k))
         
     @staticmethod
     def classification_metrics():
-        def conf_mat(y_true, y_pred, action):
-            TP = ((y_pred == 1) & (y_true == 1)).sum()
-            FP = ((y_pred == 1) & (y_true == 0)).sum()
-            TN = ((y_pred == 0) & (y_true == 0)).sum()
-            FN = ((y_pred == 0) & (y_true == 1)).sum()
-            return action(TP, FP, TN, FN)
-            
+        # binary metrics use 1 as the positive class
         return PredictionMetrics({
-            'accuracy' : lambda y_true, y_pred: conf_mat(y_true, y_pred, lambda TP, FP, TN, FN: (TP+TN)/(TP+TN+FP+FN)),
-            'precision' : lambda y_true, y_pred: conf_mat(y_true, y_pred, lambda TP, FP, TN, FN: TP/(TP+FP)),
-            # ...
-        }, best_measure = ('accuracy', 'max'))
-        
+            'accuracy' : lambda C: np.trace(C)/np.sum(C),
+            'precision' : lambda C: C[1,1]/np.sum(C[:,1]),
+            'recall' : lambda C: C[1,1]/np.sum(C[1,:]),
+            'f1' : lambda C: 2*C[1,1]/(np.sum(C[:,1])+np.sum(C[1,:])),
+        }, best_measure = ('accuracy', 'max'), prepare=PredictionMetrics.confusion_matrix)
+        
+        
+class ResultCache:
+    # test fold predictions of finished (model, config, fold, data) runs, in a SQLite file
+    def __init__(self, path:str):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, y_pred BLOB)")
+        self.connection.commit()
+    
+    @staticmethod
+    def key(model_type: type, cfg:dict, k:int, data_hash:str)->str:
+        model_name = f"{model_type.__module__}.{model_type.__qualname__}"
+        return json.dumps([model_name, cfg, k, data_hash], sort_keys=True, default=repr)
         
+    def get(self, key:str):
+        row = self.connection.execute("SELECT y_pred FROM results WHERE key = ?", (key,)).fetchone()
+        return None if row is None else np.load(io.BytesIO(row[0]))
+    
+    def put(self, key:str, y_pred):
+        buffer = io.BytesIO()
+        np.save(buffer, np.asarray(y_pred))
+        self.connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?)", (key, buffer.getvalue()))
+        self.connection.commit()
+
+
+def _fit_predict(model_type: type, cfgs:list[dict], x_train, y_train, x_test):
+    # test predictions of every config, configs after the first one only change n_estimators
+    # and grow the same warm started model
+    model = None
+    y_preds = []
+    for cfg in cfgs:
+        if model is None:
+            model = model_type(**cfg, **({'warm_start':True} if len(cfgs)>1 else {}))
+        else:
+            model.n_estimators = cfg['n_estimators']
+        model.fit(x_train, y_train)
+        y_preds.append(model.predict(x_test))
+    return y_preds
+
+
+def _load_worker_data(X_path:str, Y_path:str, n_folds:int):
+    X, Y = np.load(X_path, mmap_mode="r"), np.load(Y_path, mmap_mode="r")
+    return {"cross_validation": CrossValidation(X, Y, n_folds)}
+
+def _fit_predict_in_worker(model_type: type, cfgs:list[dict], k:int):
+    x_train, y_train, x_test, _ = worker_data["cross_validation"].get_fold_iteration(k)
+    return _fit_predict(model_type, cfgs, x_train, y_train, x_test)
+
+
 class ModelRunner:
-    def __init__(self, dataset_path:str):
-        loader = OccupancyEstimationDataloader(dataset_path, DateAndTimePreprocessor.process)
-        self.columns = columns = loader.input_columns
-        
-        X, Y = [], []        
-        for _x, _y in loader: 
-            X.append([_x[col] for col in columns])
-            Y.append(1 if _y>0 else 0)
-        X, Y = np.array(X), np.array(Y)
+    def __init__(self, dataset_path:str, n_samples:int|None=1000, random_state:int|None=None, cache_path:str|None=None,
+                 data_cache_dir:str|None=None):
+        # n_samples: rows kept after shuffling, None keeps the whole dataset
+        # random_state: seed of the shuffle, needed for cached results to be found again on the next run
+        # cache_path: SQLite file of the ResultCache, None disables caching
+        # data_cache_dir: if set, the processed dataset is streamed once and then loaded from .npy files there
+        if cache_path is not None and random_state is None:
+            raise ValueError("cache_path needs a random_state, cached results of an unseeded shuffle are never found again")
+        if data_cache_dir is None:
+            loader = OccupancyEstimationDataloader(dataset_path, DateAndTimePreprocessor.process)
+            self.columns = loader.input_columns
+            X, Y = loader.to_numpy(dtype=float)
+        else:
+            X, Y, self.columns = OccupancyEstimationDataloader.load_arrays(dataset_path, DateAndTimePreprocessor, data_cache_dir, dtype=float)
+        Y = (Y>0).astype(int)
 
         
         indices = np.arange(len(X))
-        np.random.shuffle(indices)
+        if random_state is None: np.random.shuffle(indices)
+        else: np.random.default_rng(random_state).shuffle(indices)
         self.X, self.Y = X[indices], Y[indices]
-        self.X, self.Y = self.X[:1000], self.Y[:1000]
+        self.X, self.Y = self.X[:n_samples], self.Y[:n_samples]
         print(self.X.shape, self.Y.shape)
         
         self.cross_validation = CrossValidation(self.X, self.Y)
+        
+        # fingerprint of everything the fold results depend on besides the model and its config
+        fingerprint = hashlib.sha256(np.ascontiguousarray(self.X).tobytes() + np.ascontiguousarray(self.Y).tobytes())
+        fingerprint.update(f"{self.X.dtype}{self.X.shape}{len(self.cross_validation.folds)}".encode())
+        self.data_hash = fingerprint.hexdigest()
+        self.cache = None if cache_path is None else ResultCache(cache_path)
+    
+    def _fit_predict_folds(self, model_type: type, tasks:list[tuple[list[dict], int]], n_jobs:int|None=None):
+        # yields the test fold predictions of every (nested configs, fold index) task, in order
+        workers = n_workers(n_jobs, len(tasks))
+        if workers == 1:
+            for cfgs, k in tasks:
+                x_train, y_train, x_test, _ = self.cross_validation.get_fold_iteration(k)
+                yield _fit_predict(model_type, cfgs, x_train, y_train, x_test)
+            return
+        
+        # the workers memory-map one copy of the data and rebuild the folds from it
+        with tempfile.TemporaryDirectory() as data_dir:
+            X_path, Y_path = os.path.join(data_dir, "X.npy"), os.path.join(data_dir, "Y.npy")
+            np.save(X_path, self.X)
+            np.save(Y_path, self.Y)
+            n_folds = len(self.cross_validation.folds)
+            with worker_pool(workers, _load_worker_data, X_path, Y_path, n_folds) as pool:
+                cfgs, folds = zip(*tasks)
+                yield from pool.map(_fit_predict_in_worker, itertools.repeat(model_type), cfgs, folds)
+    
+    def _nested_groups(self, model_type: type, configs:list[dict], indices:list[int], warm_start:bool):
+        # configs differing only in n_estimators are evaluated on one model grown in
+        # increasing n_estimators order, when the model supports warm_start
+        if not warm_start or 'n_estimators' not in configs[0] or 'warm_start' not in inspect.signature(model_type).parameters:
+            return [[i] for i in indices]
+        groups = {}
+        for i in indices:
+            key = repr({ k:v for k, v in configs[i].items() if k!='n_estimators' })
+            groups.setdefault(key, []).append(i)
+        return [ sorted(group, key=lambda i: configs[i].get('n_estimators', 0)) for group in groups.values() ]
     
-    def run(self, model_type: type, hp:HyperParameters, metrics: PredictionMetrics):
-        def perform_cv(hp_cfg):
-            metric_vals = { key:[] for key in metrics.keys() }            
-            def process_fold(x_train, y_train, x_test, y_test, k):
+    def _cross_validate(self, model_type: type, configs:list[dict], groups:list[list[int]], folds:list[int],
+                        metrics: PredictionMetrics, fold_vals:list[dict], n_jobs:int|None):
+        # adds the metrics of every config of the groups on the given folds to the fold_vals[config index] estimates
+        y_preds = {}
+        tasks = []
+        for group in groups:
+            for k in folds:
+                missing = []
+                for i in group:
+                    y_pred = None if self.cache is None else self.cache.get(ResultCache.key(model_type, configs[i], k, self.data_hash))
+                    if y_pred is None: missing.append(i)
+                    else: y_preds[(i, k)] = y_pred
+                # the uncached configs of a group are still grown from one model
+                if len(missing)>0: tasks.append((missing, k))
+        if self.cache is not None:
+            print(f"{len(y_preds)} results found in the cache")
+        
+        y_preds_iter = self._fit_predict_folds(model_type, [ ([configs[i] for i in group], k) for group, k in tasks ], n_jobs)
+        for (group, k), group_preds in zip(tasks, y_preds_iter):
+            for i, y_pred in zip(group, group_preds):
+                y_preds[(i, k)] = y_pred
+                if self.cache is not None:
+                    self.cache.put(ResultCache.key(model_type, configs[i], k, self.data_hash), y_pred)
+        
+        # metrics in group and fold order, so every list keeps the fold order
+        for group in groups:
+            print(f"Hyperparams = {[configs[i] for i in group]}")
+            for k in folds:
                 print(f"Fold {k}")
-                model = model_type(**hp_cfg)
-                model.fit(x_train, y_train)            
-                y_pred = model.predict(x_test)            
-                m_vals = metrics.apply(y_test, y_pred)
-                print(m_vals)
-                
-                for key, value in m_vals.items():
-                    metric_vals[key].append(value)                
-                
-            self.cross_validation.for_each_fold(process_fold)
+                y_test = self.cross_validation.folds[k][1]
+                for i in group:
+                    m_vals = metrics.apply(y_test, y_preds[(i, k)])
+                    print(configs[i], m_vals)
+                    for key, value in m_vals.items():
+                        fold_vals[i][key].add(value)
     
-            for key in metric_vals.keys():
-                metric_vals[key] = MetricEstimate(metric_vals[key])
-           
-            return metric_vals
+    @staticmethod
+    def _best_config(configs:list[dict], indices:list[int], fold_vals:list[dict], metrics: PredictionMetrics):
+        best_hp_cfg = {}
+        best_metrics = None
+        
+        # same order as the grid, so ties keep the first config as before
+        for i in indices:
+            if metrics.is_better(best_metrics, fold_vals[i]):
+                best_metrics = fold_vals[i]
+                best_hp_cfg = configs[i]
+        
+        return best_hp_cfg, best_metrics
     
+    def run(self, model_type: type, hp:HyperParameters, metrics: PredictionMetrics, warm_start:bool=True, n_jobs:int|None=None):
+        # n_jobs: worker processes evaluating (config, fold) pairs (None or 1: in this process, -1: one per CPU)
+        configs = list(hp.iterate_configs())
+        indices = list(range(len(configs)))
+        fold_vals = [{ key:MetricEstimate() for key in metrics.keys() } for _ in configs]
+        
+        groups = self._nested_groups(model_type, configs, indices, warm_start)
+        self._cross_validate(model_type, configs, groups, list(range(len(self.cross_validation.folds))), metrics, fold_vals, n_jobs)
+        
+        return self._best_config(configs, indices, fold_vals, metrics)
+    
+    def run_halving(self, model_type: type, hp:HyperParameters, metrics: PredictionMetrics, min_folds:int=2, factor:int=2,
+                    warm_start:bool=True, n_jobs:int|None=None):
+        # successive halving: every config is evaluated on min_folds folds, only the best 1/factor
+        # (by metrics.best_measure) are evaluated on factor times more folds, and so on up to all the folds
+        configs = list(hp.iterate_configs())
+        survivors = list(range(len(configs)))
+        fold_vals = [{ key:MetricEstimate() for key in metrics.keys() } for _ in configs]
+        
+        n_folds = len(self.cross_validation.folds)
+        if factor < 2: raise ValueError(f"Invalid factor: {factor}, must be at least 2")
+        if not 1 <= min_folds <= n_folds: raise ValueError(f"Invalid min_folds: {min_folds}, must be between 1 and {n_folds}")
+        metric_name, comp = metrics.best_measure
+        done, budget = 0, min_folds
+        while True:
+            groups = self._nested_groups(model_type, configs, survivors, warm_start)
+            self._cross_validate(model_type, configs, groups, list(range(done, budget)), metrics, fold_vals, n_jobs)
+            done = budget
+            if done == n_folds: break
+            
+            # stable sort, equal scores keep the grid order
+            scores = [ fold_vals[i][metric_name].mean for i in survivors ]
+            order = np.argsort(-np.array(scores) if comp=='max' else np.array(scores), kind='stable')
+            n_keep = max(1, math.ceil(len(survivors) / factor))
+            survivors = sorted(survivors[j] for j in order[:n_keep])
+            print(f"Kept {n_keep} configs after {done} folds")
+            budget = min(budget * factor, n_folds)
+        
+        return self._best_config(configs, survivors, fold_vals, metrics)
+    
+    def run_oob(self, model_type: type, hp:HyperParameters, metrics: PredictionMetrics):
+        # one fit per config on the whole data, scored on the out of bag predictions
+        # (model_type must accept oob_score=True and set oob_decision_function_, like the forests)
         best_hp_cfg = {}
         best_metrics = None
         
         for hp_cfg in hp.iterate_configs():
             print(f"Hyperparams = {hp_cfg}")
-            metric_vals = perform_cv(hp_cfg)
+            model = model_type(**hp_cfg, oob_score=True)
+            model.fit(self.X, self.Y)
+            
+            voted = ~np.isnan(model.oob_decision_function_).any(axis=1)
+            y_pred = np.argmax(model.oob_decision_function_[voted], axis=1)
+            m_vals = metrics.apply(self.Y[voted], y_pred)
+            print(m_vals)
+            
+            metric_vals = { key:MetricEstimate([value]) for key, value in m_vals.items() }
             if metrics.is_better(best_metrics, metric_vals):
                 best_metrics = metric_vals
                 best_hp_cfg = hp_cfg
-                
         
         return best_hp_cfg, best_metrics
             
@@ -15,80 +15,122 @@ class QPSolver:
         dim_x = np.size(df)
         dim_mu = np.size(h)
         dim_lam = np.size(g)
-        
-        dh = np.zeros(dim_x + dim_mu + dim_lam + 1)
+        Ae = np.reshape(Ae, (dim_mu, dim_x))
+        Ai = np.reshape(Ai, (dim_lam, dim_x))
+
+        dh = np.empty(dim_x + dim_mu + dim_lam + 1)
         dh[0] = ep
-        if dim_mu > 0 and dim_lam > 0:            
-            Ae_T_mu = np.matmul(Ae.T, mu)
-            Ai_T_lam = np.matmul(Ai.T, lam)
-            dh[1:dim_x+1] = np.matmul(B,d) - Ae_T_mu - Ai_T_lam + df
-            dh[dim_x+1:dim_x+dim_mu+1] = h + np.matmul(Ae, d)
-            Ai_2d = np.reshape(Ai,(dim_lam,dim_x))
-            for i in range(dim_lam):
-                dh[dim_x+dim_mu+1+i] = QPSolver.phi(ep, lam[i], g[i]+np.sum(Ai_2d[i]*d))
-        elif dim_lam == 0:
-            Ae_T_mu = np.matmul(Ae.T, mu)
-            dh[1:dim_x+1] = np.matmul(B,d) - Ae_T_mu + df
-            dh[dim_x+1:dim_x+dim_mu+1] = h + np.matmul(Ae, d)
-        elif dim_mu == 0:
-            Ai_T_lam = np.matmul(Ai.T, lam)
-            dh[1:dim_x+1] = np.matmul(B,d) - Ai_T_lam + df
-            Ai_2d = np.reshape(Ai,(dim_lam,dim_x))
-            for i in range(dim_lam):
-                dh[dim_x+1+i] = QPSolver.phi(ep, lam[i], g[i]+np.sum(Ai_2d[i]*d))
-        
+        dh[1:dim_x+1] = B @ d - Ae.T @ mu - Ai.T @ lam + df
+        dh[dim_x+1:dim_x+dim_mu+1] = h + Ae @ d
+        dh[dim_x+dim_mu+1:] = QPSolver.phi(ep, lam, g + Ai @ d)
+
         return dh
 
     @staticmethod
     def ddv(ep, d, lam, Ai, g):
-        """ Derivative of Phi=[..., phi(ep, lam[i]], g[1]+Ai[i]*d), ...] """
+        """ Derivative of Phi=[..., phi(ep, lam[i]], g[1]+Ai[i]*d), ...]
+            dd1 and dd2 are diagonal matrices, only their diagonals are returned
+        """
         dim_x = np.size(d)
         dim_lam = np.size(g)
-        dd1 = np.zeros((dim_lam, dim_lam))
-        dd2 = np.zeros((dim_lam, dim_lam))
-        v1 = np.array([0.0 for i in range(dim_lam)])
-        Ai = np.reshape(Ai,(dim_lam,dim_x))
-        for i in range(dim_lam):
-            fm = pow(lam[i]**2 + (g[i]+np.sum(Ai[i]*d))**2 + 2*ep**2, 0.5)  # originating from the F-B smoothing function
-            dd1[i,i] = 1 - lam[i]/fm
-            dd2[i,i] = 1 - (g[i]+np.sum(Ai[i]*d))/fm
-            v1[i] = -2*ep/fm
-            
+        s = g + np.reshape(Ai, (dim_lam, dim_x)) @ d
+        fm = np.sqrt(lam**2 + s**2 + 2*ep**2)  # originating from the F-B smoothing function
+        dd1 = 1 - lam/fm
+        dd2 = 1 - s/fm
+        v1 = -2*ep/fm
+
         return dd1, dd2, v1
-     
+
     @staticmethod
-    def JacobiH(ep, d, mu, lam, B, df, Ai, g, Ae, h):
-        """ Jacobi martix of H(z) """
+    def JacobiH(ep, d, mu, lam, B, df, Ai, g, Ae, h, out=None):
+        """ Jacobi martix of H(z), written into `out` when a buffer of the right shape is given """
         dim_x = np.size(d)
         dim_mu = np.size(mu)
         dim_lam = np.size(lam)
-        
+        dim = dim_x + dim_mu + dim_lam + 1
+        Ae = np.reshape(Ae, (dim_mu, dim_x))
+        Ai = np.reshape(Ai, (dim_lam, dim_x))
+        ix, imu, ilam = 1, dim_x + 1, dim_x + dim_mu + 1
+
         dd1, dd2, v1 = QPSolver.ddv(ep, d, lam, Ai, g)
-        if dim_mu > 0 and dim_lam > 0:
-            A0 = np.array([0.0 for i in range(dim_x+dim_mu+dim_lam+1)])
-            A0[0] = 1
-            A1 = np.hstack((np.zeros((dim_x,1)), B, -Ae.T, -Ai.T))
-            A2 = np.hstack((np.zeros((dim_mu,1)), Ae.reshape((dim_mu, dim_x)), np.zeros((dim_mu, dim_mu)), np.zeros((dim_mu,dim_lam))))
-            A3 = np.hstack((np.reshape(v1,(dim_lam,1)), np.matmul(dd2, Ai.reshape((dim_lam, dim_x))), np.zeros((dim_lam, dim_mu)), dd1))
-            A = np.vstack((A0, A1, A2, A3))
-        elif dim_lam == 0:
-            A0 = np.array([0.0 for i in range(dim_x+dim_mu+1)])
-            A0[0] = 1
-            A1 = np.hstack((np.zeros((dim_x,1)), B, -Ae.T))
-            A2 = np.hstack((np.zeros((dim_mu,1)), Ae.reshape((dim_mu, dim_x)), np.zeros((dim_mu, dim_mu))))
-            A = np.vstack((A0, A1, A2))
-        elif dim_mu == 0:
-            A0 = np.array([0.0 for i in range(dim_x+dim_lam+1)])
-            A0[0] = 1
-            A1 = np.hstack((np.zeros((dim_x,1)), B, -Ai.T))
-            A2 = np.hstack((np.reshape(v1,(dim_lam,1)), np.matmul(dd2, Ai.reshape((dim_lam, dim_x))), dd1))
-            A = np.vstack((A0, A1, A2))
-       
-        return A 
-       
+        A = np.empty((dim, dim)) if out is None else out
+        A.fill(0)
+        A[0, 0] = 1
+        A[ix:imu, ix:imu] = B
+        A[ix:imu, imu:ilam] = -Ae.T
+        A[ix:imu, ilam:] = -Ai.T
+        A[imu:ilam, ix:imu] = Ae
+        A[ilam:, 0] = v1
+        np.multiply(dd2[:, None], Ai, out=A[ilam:, ix:imu])
+        A[ilam:, ilam:][np.diag_indices(dim_lam)] = dd1
+
+        return A
+
     @staticmethod
-    def quadprog_smoothNewton(B, df, Ai, g, Ae, h, maxk=100):
-        """ quadprog_smoothNewton solves the quadratic programming problem using the smoothing Newton method"""
+    def is_box(Ai):
+        """ Checks whether the inequality constraints are the box constraints Ai=[I;-I] """
+        Ai = np.atleast_2d(Ai)
+        n = Ai.shape[1]
+        if Ai.shape[0] != 2*n:
+            return False
+        I = np.eye(n)
+        return np.array_equal(Ai[:n], I) and np.array_equal(Ai[n:], -I)
+
+    @staticmethod
+    def schur_step(ep, d, mu, lam, B, Ai, g, Ae, b):
+        """ Solves JacobiH(z)*dz = b for box constraints Ai=[I;-I] by eliminating the diagonal
+            complementarity blocks, leaving a single (dim_x+dim_mu) system to factorize.
+            The d rows are scaled by dd1 instead of divided by it, so active constraints
+            (dd1 -> 0 as ep -> 0) keep the reduced system well conditioned.
+        """
+        dim_x = np.size(d)
+        dim_mu = np.size(mu)
+        Ae = np.reshape(Ae, (dim_mu, dim_x))
+
+        dd1, dd2, v1 = QPSolver.ddv(ep, d, lam, Ai, g)
+        de = b[0]
+        b_x = b[1:dim_x+1]
+        b_mu = b[dim_x+1:dim_x+dim_mu+1]
+        c = b[dim_x+dim_mu+1:] - v1*de
+        l1, u1 = dd1[:dim_x], dd1[dim_x:]
+        l2, u2 = dd2[:dim_x], dd2[dim_x:]
+        cl, cu = c[:dim_x], c[dim_x:]
+
+        # lower rows: l2*dd + l1*dlam_l = cl, upper rows: -u2*dd + u1*dlam_u = cu
+        p = l1*u1
+        S = np.empty((dim_x+dim_mu, dim_x+dim_mu))
+        np.multiply(p[:, None], B, out=S[:dim_x, :dim_x])
+        S[:dim_x, :dim_x][np.diag_indices(dim_x)] += l2*u1 + u2*l1
+        S[:dim_x, dim_x:] = -p[:, None]*Ae.T
+        S[dim_x:, :dim_x] = Ae
+        S[dim_x:, dim_x:] = 0
+        r = p*b_x + u1*cl - l1*cu
+
+        sol = np.linalg.solve(S, np.concatenate([r, b_mu]))
+        dd = sol[:dim_x]
+        dmu = sol[dim_x:]
+
+        # dlam_l - dlam_u is given by the d rows, the other one by the better conditioned lam row
+        res = B @ dd - Ae.T @ dmu - b_x
+        lower = l1 >= u1
+        dlam_l = np.empty(dim_x)
+        dlam_u = np.empty(dim_x)
+        dlam_l[lower] = (cl[lower] - l2[lower]*dd[lower])/l1[lower]
+        dlam_u[lower] = dlam_l[lower] - res[lower]
+        upper = ~lower
+        dlam_u[upper] = (cu[upper] + u2[upper]*dd[upper])/u1[upper]
+        dlam_l[upper] = res[upper] + dlam_u[upper]
+
+        return np.concatenate([[de], dd, dmu, dlam_l, dlam_u])
+
+    @staticmethod
+    def quadprog_smoothNewton(B, df, Ai, g, Ae, h, maxk=100, linsolve='dense'):
+        """ quadprog_smoothNewton solves the quadratic programming problem using the smoothing Newton method
+            linsolve: 'dense' solves the full Jacobian system, 'schur' eliminates the complementarity
+                blocks when Ai is a box constraint matrix (falls back to 'dense' otherwise)
+        """
+        if linsolve not in ('dense', 'schur'):
+            raise ValueError(f"Invalid linsolve: {linsolve}")
         
         dim_x = np.size(df)
         dim_mu = np.size(h)
@@ -108,6 +150,12 @@ class QPSolver:
         lam_k = ep_k*np.array([1.0 for i in range(dim_lam)])
         # z_k = np.hstack((np.array([ep_k]), d_k, mu_k, lam_k))
         
+        if linsolve == 'schur' and not QPSolver.is_box(Ai):
+            linsolve = 'dense'
+        if linsolve == 'dense':
+            # Jacobian buffer reused across iterations
+            A = np.empty((dim_x + dim_mu + dim_lam + 1, dim_x + dim_mu + dim_lam + 1))
+        
         while k < maxk:
             
             dh = QPSolver.dah(ep_k, d_k, mu_k, lam_k, B, df, Ai, g, Ae, h)
@@ -116,10 +164,13 @@ class QPSolver:
                 break
             
             # Calculating the Newton step for H(z) = 0
-            A = QPSolver.JacobiH(ep_k, d_k, mu_k, lam_k, B, df, Ai, g, Ae, h)
-            beta = gamma * (np.linalg.norm(dh)) * min(1, np.linalg.norm(dh))
+            beta = gamma * mp * min(1, mp)
             b = beta*u - dh
-            dz = np.linalg.solve(A, b)
+            if linsolve == 'schur':
+                dz = QPSolver.schur_step(ep_k, d_k, mu_k, lam_k, B, Ai, g, Ae, b)
+            else:
+                QPSolver.JacobiH(ep_k, d_k, mu_k, lam_k, B, df, Ai, g, Ae, h, out=A)
+                dz = np.linalg.solve(A, b)
             if dim_mu > 0  and dim_lam >0:
                 de = dz[0]
                 dd = dz[1:dim_x+1]
@@ -143,7 +194,7 @@ class QPSolver:
             while im < 20:
                 alpha = rho**im
                 dh1 = QPSolver.dah(ep_k+alpha*de, d_k+alpha*dd, mu_k+alpha*dmu, lam_k+alpha*dlam, B, df, Ai, g, Ae, h)
-                if np.linalg.norm(dh1) <= (1 - sigma*(1-gamma*ep0)*alpha)*np.linalg.norm(dh):
+                if np.linalg.norm(dh1) <= (1 - sigma*(1-gamma*ep0)*alpha)*mp:
                     mk = im
                     break
                 im += 1
@@ -181,7 +232,7 @@ class QPSolver:
 
 
     @staticmethod
-    def solve_SQP(fun, dfun, cons, dcons, x_k, mu_k, lam_k, log=False, maxIter=10):
+    def solve_SQP(fun, dfun, cons, dcons, x_k, mu_k, lam_k, log=False, maxIter=10, linsolve='dense'):
         def merit_l1(x, sigma):
             """ l1-merit function"""
             f = fun(x)
@@ -265,7 +316,7 @@ class QPSolver:
         
         while k < maxIter:
             # Solving the QP subproblem
-            y_qp, mu_qp, lam_qp, _ = QPSolver.quadprog_smoothNewton(B_k, df_k, Ai_k, g_k, Ae_k, h_k)
+            y_qp, mu_qp, lam_qp, _ = QPSolver.quadprog_smoothNewton(B_k, df_k, Ai_k, g_k, Ae_k, h_k, linsolve=linsolve)
             
             # Checking the stop criterion
             gradient_of_Lagrangian = dla(x_k, mu_k, lam_k)
@@ -368,4 +419,29 @@ class QPSolver:
             plt.show()
         """        
         
-        return x_k, mu_k, lam_k, val
\ No newline at end of file
+        return x_k, mu_k, lam_k, val
+
+def test_schur_step():
+    """ schur_step must match the dense solve of the full Jacobian system, also for ep -> 0 """
+    rng = np.random.default_rng(0)
+    n = 50
+    M = rng.random((n, n))
+    B = M @ M.T / n + np.eye(n)
+    df = rng.random(n)
+    Ai = np.concatenate([np.eye(n), -np.eye(n)], axis=0)
+    g = np.concatenate([np.zeros(n), np.ones(n)])
+    Ae = np.concatenate([np.ones(n//2), -np.ones(n-n//2)]).reshape((1, -1))
+    h = np.zeros(1)
+    d, mu, lam = rng.random(n), rng.random(1), rng.random(2*n)
+    b = rng.standard_normal(1+n+1+2*n)
+    
+    for ep in [0.05, 1e-3, 1e-9]:
+        dz = QPSolver.schur_step(ep, d, mu, lam, B, Ai, g, Ae, b)
+        expected = np.linalg.solve(QPSolver.JacobiH(ep, d, mu, lam, B, df, Ai, g, Ae, h), b)
+        error = np.max(np.abs(dz - expected))
+        print(f"ep={ep}: max |schur - dense| = {error:.2e}")
+        assert error < 1e-10
+
+
+if __name__ == "__main__":
+    test_schur_step()
@@ -1,108 +1,297 @@
+import heapq
+import itertools
+
 import numpy as np
 
 from .model import Model
 
 
 ALLOWED_METHODS = ["gini", "entropy"]
+NODE_ARRAYS = ["feature_idx", "threshold", "left", "right", "value"]
 
 
 class DecisionTree(Model):
     @classmethod
-    def _gini(cls, feat: np.ndarray):
-        classes, counts = np.unique(feat, return_counts=True)
-        probabilities = counts / len(feat)
-        gini = 1 - np.sum(probabilities**2)
-        return gini
+    def _gini(cls, counts: np.ndarray):
+        # one row of class counts per candidate node
+        totals = np.maximum(counts.sum(axis=1, keepdims=True), 1)
+        probabilities = counts / totals
+        return 1 - np.sum(probabilities**2, axis=1)
 
     @classmethod
-    def _entropy(cls, feat: np.ndarray):
-        classes, counts = np.unique(feat, return_counts=True)
-        probabilities = counts / len(feat)
-        entropy = -np.sum(probabilities * np.log2(probabilities + 1e-9))
-        return entropy
+    def _entropy(cls, counts: np.ndarray):
+        totals = np.maximum(counts.sum(axis=1, keepdims=True), 1)
+        probabilities = counts / totals
+        return -np.sum(probabilities * np.log2(probabilities + 1e-9), axis=1)
 
-    def __init__(self, method: str = "gini", max_depth: int = np.inf):
+    def __init__(
+        self,
+        method: str = "gini",
+        max_depth: int = np.inf,
+        max_bins: int | None = None,
+        min_samples_split: int = 2,
+        min_samples_leaf: int = 1,
+        max_leaf_nodes: int | None = None,
+    ):
+        """max_bins: if set, features are pre-binned into at most max_bins quantile
+        thresholds and splits are searched on the bin histograms
+        min_samples_split: nodes with fewer samples are not split
+        min_samples_leaf: splits leaving fewer samples on either side are skipped
+        max_leaf_nodes: if set, the tree is grown best first up to this many leaves"""
         if method not in ALLOWED_METHODS:
             raise ValueError(f"Invalid method! Allowed methods: {ALLOWED_METHODS}")
         self.impurity = self._gini if method == "gini" else self._entropy
         self.tree = None
         self.max_depth = max_depth
+        self.max_bins = max_bins
+        self.min_samples_split = min_samples_split
+        self.min_samples_leaf = min_samples_leaf
+        self.max_leaf_nodes = max_leaf_nodes
 
-    def _information_gain(self, feat: np.ndarray, left_idx: int, right_idx: int):
-        parent_impurity = self.impurity(feat)
-        n = len(feat)
-        n_left, n_right = len(left_idx), len(right_idx)
+    def _bin_features(self, X: np.ndarray):
+        # only the candidate features are binned, the other codes stay 0
+        self.bin_edges = [None] * X.shape[1]
+        codes = np.zeros(X.shape, dtype=np.intp)
+        quantiles = np.linspace(0, 1, self.max_bins + 1)[1:]
+        for feature_idx in self.features:
+            edges = np.unique(np.quantile(X[:, feature_idx], quantiles))
+            # code b <=> x <= edges[b] (and x > edges[b - 1])
+            codes[:, feature_idx] = np.searchsorted(edges, X[:, feature_idx])
+            self.bin_edges[feature_idx] = edges
+        return codes
 
-        weighted_avg = (n_left / n) * self.impurity(feat[left_idx]) + (
-            n_right / n
-        ) * self.impurity(feat[right_idx])
-        return parent_impurity - weighted_avg
+    def _left_class_counts(self, feat: np.ndarray, y: np.ndarray, feature_idx: int):
+        """Class counts of the samples with feat <= threshold, for every candidate threshold"""
+        if self.max_bins is not None:
+            n_bins = len(self.bin_edges[feature_idx])
+            counts = np.bincount(
+                feat * self.n_classes + y, minlength=n_bins * self.n_classes
+            ).reshape((n_bins, self.n_classes))
+            return np.cumsum(counts, axis=0), np.arange(n_bins)
 
-        return parent_impurity - weighted_avg
+        order = np.argsort(feat, kind="stable")
+        sorted_feat = feat[order]
+        left_counts = np.cumsum(np.eye(self.n_classes, dtype=np.intp)[y[order]], axis=0)
+        last = np.append(sorted_feat[1:] != sorted_feat[:-1], True)
+        return left_counts[last], sorted_feat[last]
 
-    def _best_split(self, X: np.ndarray, y: np.ndarray):
+    def _best_split(self, X: np.ndarray, y: np.ndarray, samples: np.ndarray):
+        """Best split of the node holding the rows samples, None if no split is allowed.
+        The returned cut is in the same space as X (bin codes when max_bins is set)"""
         best_gain = -1
         best_split = None
 
-        for feature_idx in range(X.shape[1]):
-            thresholds = np.unique(X[:, feature_idx])
-            for threshold in thresholds:
-                left_idx = np.where(X[:, feature_idx] <= threshold)[0]
-                right_idx = np.where(X[:, feature_idx] > threshold)[0]
+        n = len(samples)
+        y_node = y[samples]
+        parent_counts = np.bincount(y_node, minlength=self.n_classes)
+        parent_impurity = self.impurity(parent_counts[None, :])[0]
+
+        for feature_idx in self.features:
+            left_counts, thresholds = self._left_class_counts(
+                X[samples, feature_idx], y_node, feature_idx
+            )
+            right_counts = parent_counts - left_counts
+            n_left = left_counts.sum(axis=1)
+            n_right = n - n_left
 
-                if len(left_idx) == 0 or len(right_idx) == 0:
-                    continue
+            gain = parent_impurity - (
+                (n_left / n) * self.impurity(left_counts)
+                + (n_right / n) * self.impurity(right_counts)
+            )
+            too_small = np.minimum(n_left, n_right) < max(self.min_samples_leaf, 1)
+            gain[too_small] = -np.inf
+            best = np.argmax(gain)
 
-                gain = self._information_gain(y, left_idx, right_idx)
+            if gain[best] > best_gain:
+                best_gain = gain[best]
+                best_split = {
+                    "feature_idx": feature_idx,
+                    "threshold": thresholds[best],
+                    "cut": thresholds[best],
+                    "gain": best_gain,
+                }
 
-                if gain > best_gain:
-                    best_gain = gain
-                    best_split = {
-                        "feature_idx": feature_idx,
-                        "threshold": threshold,
-                        "left_idx": left_idx,
-                        "right_idx": right_idx,
-                    }
+        if best_split is not None and self.max_bins is not None:
+            edges = self.bin_edges[best_split["feature_idx"]]
+            best_split["threshold"] = edges[best_split["cut"]]
 
         return best_split
 
-    def _build_tree(self, X: np.ndarray, y: np.ndarray, depth: int):
-        if len(np.unique(y)) == 1 or (self.max_depth and depth >= self.max_depth):
-            return {"value": np.bincount(y).argmax()}
+    def _partition(self, X: np.ndarray, samples: np.ndarray, split: dict):
+        """Reorders the samples view in place, left rows first; returns the left count"""
+        go_left = X[samples, split["feature_idx"]] <= split["cut"]
+        n_left = np.count_nonzero(go_left)
+        samples[:] = np.concatenate((samples[go_left], samples[~go_left]))
+        return n_left
+
+    def _make_leaf(self, X: np.ndarray, y: np.ndarray, samples: np.ndarray, depth: int):
+        """Leaf node for the samples and the split it would be expanded with (None if it stays a leaf)"""
+        counts = np.bincount(y[samples], minlength=self.n_classes)
+        leaf = {"value": counts.argmax()}
+        if (
+            np.count_nonzero(counts) == 1
+            or (self.max_depth and depth >= self.max_depth)
+            or len(samples) < self.min_samples_split
+        ):
+            return leaf, None
+        return leaf, self._best_split(X, y, samples)
 
-        split = self._best_split(X, y)
+    @staticmethod
+    def _expand(leaf: dict, split: dict, left: dict, right: dict):
+        # turns the leaf dict into an internal node in place
+        del leaf["value"]
+        leaf["feature_idx"] = split["feature_idx"]
+        leaf["threshold"] = split["threshold"]
+        leaf["left"] = left
+        leaf["right"] = right
+
+    def _build_tree(
+        self, X: np.ndarray, y: np.ndarray, samples: np.ndarray, depth: int
+    ):
+        """Depth first growth, samples is a view into the shared index buffer"""
+        node, split = self._make_leaf(X, y, samples, depth)
         if not split:
-            return {"value": np.bincount(y).argmax()}
+            return node
 
-        left_subtree = self._build_tree(
-            X[split["left_idx"]], y[split["left_idx"]], depth=depth + 1
-        )
-        right_subtree = self._build_tree(
-            X[split["right_idx"]], y[split["right_idx"]], depth=depth + 1
-        )
+        n_left = self._partition(X, samples, split)
+        left_subtree = self._build_tree(X, y, samples[:n_left], depth=depth + 1)
+        right_subtree = self._build_tree(X, y, samples[n_left:], depth=depth + 1)
 
-        return {
-            "feature_idx": split["feature_idx"],
-            "threshold": split["threshold"],
-            "left": left_subtree,
-            "right": right_subtree,
-        }
+        self._expand(node, split, left_subtree, right_subtree)
+        return node
+
+    def _build_tree_best_first(self, X: np.ndarray, y: np.ndarray, samples: np.ndarray):
+        """Best first growth: always expands the leaf with the largest weighted impurity
+        decrease, until max_leaf_nodes leaves exist"""
+        frontier = []
+        # breaks ties in creation order and keeps the dicts out of the comparisons
+        order = itertools.count()
+
+        def push(samples: np.ndarray, depth: int):
+            leaf, split = self._make_leaf(X, y, samples, depth)
+            if split:
+                priority = -split["gain"] * len(samples)
+                heapq.heappush(
+                    frontier, (priority, next(order), leaf, split, samples, depth)
+                )
+            return leaf
+
+        root = push(samples, depth=0)
+        n_leaves = 1
+        while frontier and n_leaves < self.max_leaf_nodes:
+            _, _, leaf, split, samples, depth = heapq.heappop(frontier)
+            n_left = self._partition(X, samples, split)
+            left = push(samples[:n_left], depth + 1)
+            right = push(samples[n_left:], depth + 1)
+            self._expand(leaf, split, left, right)
+            n_leaves += 1
+        return root
+
+    def _compile(self, tree: dict):
+        """Flattens the nested dict tree into node arrays (preorder, leaves have feature_idx -1)"""
+        nodes = {name: [] for name in NODE_ARRAYS}
 
-    def fit(self, X: np.ndarray, y: np.ndarray, *args, **kwargs):
-        self.tree = self._build_tree(X, y, depth=0)
+        def add(node: dict):
+            idx = len(nodes["value"])
+            is_leaf = "value" in node
+            nodes["feature_idx"].append(-1 if is_leaf else node["feature_idx"])
+            nodes["threshold"].append(np.nan if is_leaf else node["threshold"])
+            nodes["value"].append(node["value"] if is_leaf else -1)
+            nodes["left"].append(-1)
+            nodes["right"].append(-1)
+            if not is_leaf:
+                nodes["left"][idx] = add(node["left"])
+                nodes["right"][idx] = add(node["right"])
+            return idx
 
-    def _predict_single(self, x: np.ndarray, tree: dict):
-        if "value" in tree:
-            return tree["value"]
+        add(tree)
+        self.feature_idx = np.array(nodes["feature_idx"], dtype=np.intp)
+        self.threshold = np.array(nodes["threshold"], dtype=float)
+        self.left = np.array(nodes["left"], dtype=np.intp)
+        self.right = np.array(nodes["right"], dtype=np.intp)
+        self.value = np.array(nodes["value"], dtype=np.intp)
 
-        feature_value = x[tree["feature_idx"]]
-        if feature_value <= tree["threshold"]:
-            return self._predict_single(x, tree["left"])
+    def _to_dict(self, node: int = 0):
+        if self.feature_idx[node] < 0:
+            return {"value": self.value[node]}
+        return {
+            "feature_idx": self.feature_idx[node],
+            "threshold": self.threshold[node],
+            "left": self._to_dict(self.left[node]),
+            "right": self._to_dict(self.right[node]),
+        }
+
+    def fit(
+        self,
+        X: np.ndarray,
+        y: np.ndarray,
+        *args,
+        sample_indices: np.ndarray | None = None,
+        feature_indices: np.ndarray | None = None,
+        **kwargs,
+    ):
+        """sample_indices: rows of X to train on (repetitions allowed, e.g. a bootstrap
+        sample), so that callers don't have to copy X[sample_indices]
+        feature_indices: the only columns of X the splits may use, in search order.
+        The tree still indexes the full rows of X, in fit as well as in predict"""
+        self.n_classes = np.max(y) + 1
+        if feature_indices is None:
+            self.features = np.arange(X.shape[1])
+        else:
+            self.features = np.asarray(feature_indices, dtype=np.intp)
+        if self.max_bins is not None:
+            X = self._bin_features(X)
+        # the only per-sample buffer, every node owns a contiguous slice of it
+        if sample_indices is None:
+            samples = np.arange(len(y))
+        else:
+            samples = np.array(sample_indices, dtype=np.intp)
+        if self.max_leaf_nodes is None:
+            self.tree = self._build_tree(X, y, samples, depth=0)
         else:
-            return self._predict_single(x, tree["right"])
+            self.tree = self._build_tree_best_first(X, y, samples)
+        self._compile(self.tree)
+
+    def predict(self, X_set: np.ndarray, *args, **kwargs) -> np.ndarray:
+        # all the rows go down one level per iteration
+        node = np.zeros(len(X_set), dtype=np.intp)
+        rows = np.arange(len(X_set))
+        while True:
+            rows = rows[self.feature_idx[node[rows]] >= 0]
+            if len(rows) == 0:
+                break
+            current = node[rows]
+            go_left = X_set[rows, self.feature_idx[current]] <= self.threshold[current]
+            node[rows] = np.where(go_left, self.left[current], self.right[current])
+        return self.value[node]
 
     def predict_one(self, X: np.ndarray, *args, **kwargs):
-        return self._predict_single(X, self.tree)
+        node = 0
+        while self.feature_idx[node] >= 0:
+            if X[self.feature_idx[node]] <= self.threshold[node]:
+                node = self.left[node]
+            else:
+                node = self.right[node]
+        return self.value[node]
+
+    def save(self, path: str):
+        # through a file handle, np.savez would append ".npz" to a path without it
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                method="gini" if self.impurity == self._gini else "entropy",
+                max_depth=self.max_depth,
+                **{name: getattr(self, name) for name in NODE_ARRAYS},
+            )
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as data:
+            tree = cls(method=str(data["method"]), max_depth=data["max_depth"].item())
+            for name in NODE_ARRAYS:
+                setattr(tree, name, data[name])
+        tree.tree = tree._to_dict()
+        return tree
 
 
 def test_decision_tree():
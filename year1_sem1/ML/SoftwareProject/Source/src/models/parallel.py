@@ -0,0 +1,23 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# data of a worker process, filled once by the initializer of worker_pool
+worker_data = {}
+
+
+def n_workers(n_jobs: int | None, n_tasks: int):
+    """Worker processes to use for n_tasks tasks (n_jobs None or 1: in this process, -1: one per CPU)"""
+    n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs or 1
+    return max(1, min(n_jobs, n_tasks))
+
+
+def _init_worker(load, args: tuple):
+    worker_data.update(load(*args))
+
+
+def worker_pool(n_workers: int, load, *args):
+    """Process pool whose workers run load(*args) once at startup and keep the returned dict in worker_data.
+    load must be a module-level function, so that it can be sent to the workers"""
+    return ProcessPoolExecutor(
+        n_workers, initializer=_init_worker, initargs=(load, args)
+    )
@@ -1,9 +1,28 @@
+import itertools
 import math
+import os
+import tempfile
 
 import numpy as np
 
 from .decision_tree import DecisionTree, ALLOWED_METHODS
 from .model import Model
+from .parallel import n_workers, worker_data, worker_pool
+
+
+def _load_worker_data(X_path: str, y_path: str):
+    return {
+        "X": np.load(X_path, mmap_mode="r"),
+        "y": np.load(y_path, mmap_mode="r"),
+    }
+
+
+def _fit_tree_in_worker(
+    seed: np.random.SeedSequence, max_features: int, tree_params: dict
+):
+    return RandomForest._fit_tree(
+        worker_data["X"], worker_data["y"], seed, max_features, tree_params
+    )
 
 
 class RandomForest(Model):
@@ -13,7 +32,20 @@ class RandomForest(Model):
         max_depth: int = np.inf,
         max_features: int | str | None = None,
         criterion: str = "gini",
+        n_jobs: int | None = None,
+        random_state: int | None = None,
+        oob_score: bool = False,
+        warm_start: bool = False,
     ):
+        """n_jobs: number of worker processes training trees (None or 1: train in this
+        process, -1: one per CPU)
+        random_state: seed of the bootstrap samples and feature subsets, the fitted
+        forest does not depend on n_jobs
+        oob_score: if set, every row is also predicted by the trees that did not see it
+        (oob_prediction_, oob_decision_function_) and the accuracy of these predictions
+        is kept in oob_score_, like sklearn's RandomForestClassifier
+        warm_start: if set, fit keeps the trees already grown and only adds trees up to
+        n_estimators (it must be called with the same X and y)"""
         if criterion not in ALLOWED_METHODS:
             raise ValueError(f"Invalid method: {criterion}")
 
@@ -21,16 +53,23 @@ class RandomForest(Model):
         self.max_depth = max_depth
         self.max_features = max_features
         self.method = criterion
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.oob_score = oob_score
+        self.warm_start = warm_start
         self.trees = []
+        # one packed bitset of the bootstrap rows per tree
+        self.in_bag = []
 
     @classmethod
-    def _bootstrap_sample(cls, X: np.ndarray, y: np.ndarray):
-        n_samples = X.shape[0]
-        indices = np.random.choice(n_samples, size=n_samples, replace=True)
-        return X[indices], y[indices]
+    def _bootstrap_indices(cls, rng: np.random.Generator, n_samples: int):
+        return rng.choice(n_samples, size=n_samples, replace=True)
 
-    def _select_features(self, X: np.ndarray):
-        n_features = X.shape[1]
+    @classmethod
+    def _select_features(cls, rng: np.random.Generator, n_features: int, size: int):
+        return rng.choice(n_features, size=size, replace=False)
+
+    def _n_selected_features(self, n_features: int):
         max_features = self.max_features or n_features
 
         if max_features == "sqrt":
@@ -39,30 +78,114 @@ class RandomForest(Model):
             max_features = int(math.log2(n_features))
         elif not isinstance(max_features, int):
             raise ValueError(f"Invalid max features: {max_features}")
+        return max_features
 
-        feature_indices = np.random.choice(n_features, size=max_features, replace=False)
-        return X[:, feature_indices], feature_indices
+    @classmethod
+    def _fit_tree(
+        cls,
+        X: np.ndarray,
+        y: np.ndarray,
+        seed: np.random.SeedSequence,
+        max_features: int,
+        tree_params: dict,
+    ):
+        # everything random about a tree comes from its own seed
+        rng = np.random.default_rng(seed)
+        indices = cls._bootstrap_indices(rng, X.shape[0])
+        feature_indices = cls._select_features(rng, X.shape[1], max_features)
+
+        tree = DecisionTree(**tree_params)
+        # the tree reads the shared X through both index arrays, nothing is copied
+        tree.fit(X, y, sample_indices=indices, feature_indices=feature_indices)
+        # bitset of the rows drawn at least once
+        in_bag = np.packbits(np.bincount(indices, minlength=X.shape[0]) > 0)
+        return tree, feature_indices, in_bag
+
+    def _fit_trees(self, X: np.ndarray, y: np.ndarray, seeds: list, max_features: int):
+        """Yields (tree, feature_indices, in_bag) for every seed, in order"""
+        tree_params = {"method": self.method, "max_depth": self.max_depth}
+        workers = n_workers(self.n_jobs, len(seeds))
+        if workers == 1:
+            for seed in seeds:
+                yield self._fit_tree(X, y, seed, max_features, tree_params)
+            return
+
+        # the workers memory-map one copy of the data, tasks only carry the tree seeds
+        with tempfile.TemporaryDirectory() as data_dir:
+            X_path = os.path.join(data_dir, "X.npy")
+            y_path = os.path.join(data_dir, "y.npy")
+            np.save(X_path, X)
+            np.save(y_path, y)
+            with worker_pool(workers, _load_worker_data, X_path, y_path) as pool:
+                yield from pool.map(
+                    _fit_tree_in_worker,
+                    seeds,
+                    itertools.repeat(max_features),
+                    itertools.repeat(tree_params),
+                )
+
+    def _add_tree(
+        self, X: np.ndarray, tree: DecisionTree, feature_indices: np.ndarray, in_bag
+    ):
+        self.trees.append((tree, feature_indices))
+        self.in_bag.append(in_bag)
+        if self.oob_score:
+            out_of_bag = np.flatnonzero(np.unpackbits(in_bag, count=X.shape[0]) == 0)
+            votes = tree.predict(X[out_of_bag])
+            self.oob_votes[out_of_bag, votes] += 1
+
+    def _set_oob_score(self, y: np.ndarray):
+        n_votes = self.oob_votes.sum(axis=1)
+        voted = n_votes > 0
+        # rows that were in the bag of every tree have no out of bag estimate (nan)
+        self.oob_decision_function_ = (
+            self.oob_votes / np.where(voted, n_votes, np.nan)[:, None]
+        )
+        self.oob_prediction_ = np.where(voted, self.oob_votes.argmax(axis=1), -1)
+        self.oob_score_ = np.mean(self.oob_prediction_[voted] == y[voted])
 
     def fit(self, X: np.ndarray, y: np.ndarray, *args, **kwargs):
-        self.trees = []
-        for _ in range(self.n_estimators):
-            X_sample, y_sample = self._bootstrap_sample(X, y)
-            X_sample, feature_indices = self._select_features(X_sample)
-
-            tree = DecisionTree(method=self.method, max_depth=self.max_depth)
-            tree.fit(X_sample, y_sample)
-
-            self.trees.append((tree, feature_indices))
+        if not self.warm_start or not self.trees:
+            # tree i always gets the i-th child seed, so growing a forest in several
+            # fits gives the same trees as fitting it at once
+            self.seed_sequence = np.random.SeedSequence(self.random_state)
+            self.n_classes = np.max(y) + 1
+            self.trees, self.in_bag = [], []
+            if self.oob_score:
+                self.oob_votes = np.zeros((len(y), self.n_classes), dtype=np.intp)
+
+        n_new_trees = self.n_estimators - len(self.trees)
+        if n_new_trees < 0:
+            raise ValueError(
+                f"n_estimators={self.n_estimators} is less than the {len(self.trees)} "
+                "trees of the warm started forest"
+            )
+        seeds = self.seed_sequence.spawn(n_new_trees)
+        max_features = self._n_selected_features(X.shape[1])
+        # the out of bag votes are updated as soon as each tree is available
+        for tree, feature_indices, in_bag in self._fit_trees(X, y, seeds, max_features):
+            self._add_tree(X, tree, feature_indices, in_bag)
+        if self.oob_score:
+            self._set_oob_score(y)
+
+    def _votes(self, X_set: np.ndarray):
+        """Number of trees voting for each class, one row per sample"""
+        n_rows = X_set.shape[0]
+        # the trees index the full rows, feature_indices are the columns they may use
+        tree_predictions = np.stack([tree.predict(X_set) for tree, _ in self.trees])
+        # shifted so that every row counts its votes in its own n_classes slots
+        slots = np.arange(n_rows) * self.n_classes + tree_predictions
+        votes = np.bincount(slots.ravel(), minlength=n_rows * self.n_classes)
+        return votes.reshape((n_rows, self.n_classes))
+
+    def predict(self, X_set: np.ndarray, *args, **kwargs) -> np.ndarray:
+        return self._votes(X_set).argmax(axis=1)  # Majority voting
+
+    def predict_proba(self, X_set: np.ndarray) -> np.ndarray:
+        return self._votes(X_set) / len(self.trees)
 
     def predict_one(self, X: np.ndarray, *args, **kwargs):
-        tree_predictions = np.array(
-            [
-                tree.predict_one(X[feature_indices])
-                for tree, feature_indices in self.trees
-            ]
-        )
-        final_prediction = np.bincount(tree_predictions).argmax()  # Majority voting
-        return final_prediction
+        return self.predict(X[None, :])[0]
 
 
 def test_random_forest():
@@ -71,7 +194,9 @@ def test_random_forest():
 
     print(f"Expected values: {y}")
 
-    rf = RandomForest(n_estimators=6, max_depth=3, max_features="sqrt", method="gini")
+    rf = RandomForest(
+        n_estimators=6, max_depth=3, max_features="sqrt", criterion="gini"
+    )
     rf.fit(X, y)
     predictions = rf.predict(X)
     print(f"Predictions: {predictions}")
@@ -1,45 +1,92 @@
 import numpy as np
+from scipy.optimize import minimize
 from .QP import QPSolver
 from .model import Model
 
 class KernelProvider:
+    """
+        Signed 2n x 2n kernel operator [[G, -G], [-G, G]] backed by the n x n Gram matrix G,
+        the blocks are never materialised
+    """
     def __init__(self, x, kerf):
         self.kerf = kerf        
         self.n = len(x)
-        
-        self._K = []        
-        
-        for i in range(len(x)):
-            row = []
-            for j in range(0, i+1):
-                row.append(kerf(x[i], x[j]))
-            self._K.append(row)
+        self.gram = np.asarray(kerf(x, x), dtype=float)
+        self.shape = (2*self.n, 2*self.n)
     
     def K(self, i, j):
         sgn = 1
         if i>=self.n: sgn*=-1; i-=self.n
         if j>=self.n: sgn*=-1; j-=self.n
-        if i<j: i,j = j,i
-        return sgn * self._K[i][j]
+        return sgn * self.gram[i, j]
     
     def K_new(self, x, y): return self.kerf(x, y)
     
+    def _fold(self, v):
+        # G-side vector of a signed product: [v1; v2] -> v1 - v2
+        return v[:self.n] - v[self.n:]
+    
+    def Kx(self, x):
+        g = self.gram @ self._fold(x)
+        return np.concatenate([g, -g])
+    
+    def xKx(self, x):
+        s = self._fold(x)
+        return s @ self.gram @ s
+    
+    def diagonal(self):
+        d = np.diagonal(self.gram)
+        return np.concatenate([d, d])
+    
+    def __matmul__(self, x):
+        return self.Kx(x)
+    
     def __getitem__(self, pos): 
-        return self.K(*pos)
+        i, j = pos
+        if isinstance(j, (int, np.integer)):
+            if isinstance(i, (int, np.integer)):
+                return self.K(i, j)
+            if i == slice(None):
+                # whole column, the layout of the signed operator is [g; -g] up to sign
+                g = self.gram[:, j % self.n] if j < self.n else -self.gram[:, j % self.n]
+                return np.concatenate([g, -g])
+        # ints, slices and masks are turned into index arrays, arrays index as an outer product
+        i = np.arange(2*self.n)[i]
+        j = np.arange(2*self.n)[j]
+        sgn = np.multiply.outer(np.where(i >= self.n, -1, 1), np.where(j >= self.n, -1, 1))
+        block = self.gram[np.ix_(np.atleast_1d(i % self.n), np.atleast_1d(j % self.n))]
+        return sgn * block.reshape(sgn.shape)
     
     
 class Kernels:
+    """ Kernel functions work on single vectors as well as on batches of row vectors (Gram matrix) """
     @staticmethod
     def linear():        
-        return lambda x,y: x @ y        
+        return lambda x,y: x @ y.T
     
     @staticmethod
     def poly(c0): 
         def f(x, y):
-            z = np.atleast_1d(x @ y + c0)
-            return z @ z
+            return (x @ y.T + c0) ** 2
         return f
     
+    @staticmethod
+    def linear_phi():
+        return lambda x: x
+    
+    @staticmethod
+    def poly_phi(c0):
+        """ Explicit feature map of the degree 2 polynomial kernel, phi(x)*phi(y) = (x*y + c0)^2 """
+        def phi(x):
+            rows, cols = np.triu_indices(x.shape[-1], 1)
+            return np.concatenate([
+                x*x,
+                np.sqrt(2) * x[..., rows] * x[..., cols],
+                np.sqrt(2*c0) * x,
+                np.full(x.shape[:-1]+(1,), float(c0)),
+            ], axis=-1)
+        return phi
+    
 def solve_qp(K, P, C, A, x0):
     """
         min 1/2 x^t*K*x + P*x, s.t. 0<=x<=C && A*x=0
@@ -47,29 +94,13 @@ def solve_qp(K, P, C, A, x0):
     """
     n = len(P)
 
-    def xKx(x):
-        # Computes x^t * K * x aka sum(k_ij * x_i * x_j) => real number 
-        res = 0
-        for i in range(len(x)):
-            for j in range(len(x)):
-                res += K[i,j] * x[i] * x[j]
-        return res
-    
-    def Kx(x):
-        # Computes K*x => vector with shape of x
-        res = np.zeros(len(x))
-        for i in range(len(x)):
-            for j in range(len(x)):
-                res[i] += K[i,j]*x[j]
-        return res
-    
     def fun(x):
         # Objective function: 1/2 x^t*K*x + P*x
-        return 0.5 * xKx(x) + P @ x        
+        return 0.5 * K.xKx(x) + P @ x        
 
     def dfun(x):
         # Gradient of the objective function: K*x + P
-        return Kx(x) + P        
+        return K.Kx(x) + P        
 
     def cons(x):
         # Constraint functions: equality A*x = 0 and 0<=x<=C <=> x>=0, C-x>=0
@@ -88,39 +119,130 @@ def solve_qp(K, P, C, A, x0):
     # dual variables associated with inequality constraints
     lam0 = np.zeros(2*n) 
     # optimize problem
-    x_op, mu_op, lam_op, fval = QPSolver.solve_SQP(fun, dfun, cons, dcons, x0, mu0, lam0, True)
+    x_op, mu_op, lam_op, fval = QPSolver.solve_SQP(fun, dfun, cons, dcons, x0, mu0, lam0, True, linsolve='schur')
     
     return x_op
     
 
+def solve_qp_smo(K, P, C, A, x0, tol=1e-3, max_iter=-1):
+    """
+        min 1/2 x^t*K*x + P*x, s.t. 0<=x<=C && A*x=0, with A[i] in {-1, 1}
+        SMO with second order working set selection (Fan et al., 2005), K is a dense matrix
+        or a KernelProvider
+        returns the solution and the number of iterations
+    """
+    x = np.array(x0, dtype=float)
+    G = K @ x + P
+    diag = K.diagonal()
+    tau = 1e-12
+    
+    k = 0
+    while max_iter < 0 or k < max_iter:
+        up = ((A == 1) & (x < C)) | ((A == -1) & (x > 0))
+        low = ((A == 1) & (x > 0)) | ((A == -1) & (x < C))
+        
+        yG = -A * G
+        i = np.flatnonzero(up)[np.argmax(yG[up])]
+        m = yG[i]
+        if m - np.min(yG[low]) < tol:
+            break
+        
+        # j minimizes the decrease of the objective along the direction defined by {i, j}
+        K_i = K[:, i]
+        cand = low & (yG < m)
+        b = m - yG[cand]
+        a = diag[i] + diag[cand] - 2 * A[i] * A[cand] * K_i[cand]
+        a[a <= 0] = tau
+        j = np.flatnonzero(cand)[np.argmin(-b * b / a)]
+        
+        # x[i] += A[i]*t, x[j] -= A[j]*t keeps A*x constant
+        a_ij = max(diag[i] + diag[j] - 2 * A[i] * A[j] * K_i[j], tau)
+        t_i = C - x[i] if A[i] == 1 else x[i]
+        t_j = x[j] if A[j] == 1 else C - x[j]
+        t = min((m - yG[j]) / a_ij, t_i, t_j)
+        
+        x[i] += A[i] * t
+        x[j] -= A[j] * t
+        G += t * (A[i] * K_i - A[j] * K[:, j])
+        k += 1
+    
+    return np.clip(x, 0, C), k
+
+
+def solve_primal(phi_x, y, C, epsilon, tol=1e-3, max_iter=1000):
+    """
+        min 1/2 |w|^2 + C*sum(max(0, |y_i - w*phi_i - b| - epsilon)^2) on explicit features phi_x
+        squared epsilon-insensitive loss (L2-loss SVR as in LIBLINEAR) so that L-BFGS applies,
+        every iteration is a couple of (n x dim) matrix products, i.e. linear in the number of samples
+        returns w, b and the number of iterations
+    """
+    n, dim = phi_x.shape
+    
+    def fun(wb):
+        w, b = wb[:-1], wb[-1]
+        r = phi_x @ w + b - y
+        e = np.maximum(np.abs(r) - epsilon, 0)
+        de = 2 * C * np.sign(r) * e
+        return 0.5 * w @ w + C * e @ e, np.append(w + phi_x.T @ de, np.sum(de))
+    
+    res = minimize(fun, np.zeros(dim + 1), jac=True, method='L-BFGS-B', options={'maxiter': max_iter, 'gtol': tol})
+    return res.x[:-1], res.x[-1], res.nit
+
+
 class MySVR(Model):
     def __init__(self,
         epsilon=1e-2,
         kernel='linear',
         degree=2,
         coef0=0,
-        C=1
+        C=1,
+        solver='sqp',
+        tol=1e-3,
+        max_iter=-1
     ):
+        """ solver: 'sqp' (generic SQPSolver), 'smo' (dedicated box-constrained QP solver) or
+                'primal' (L-BFGS on the explicit feature map, linear in the number of samples)
+            tol, max_iter: stopping criteria of the 'smo' and 'primal' solvers, max_iter=-1 means
+                no limit for 'smo' and 1000 for 'primal'
+        """
         self.epsilon = epsilon
         self.C = C
+        self.tol = tol
+        self.max_iter = max_iter
+        self.kernel = kernel
+        self.coef0 = coef0
+        
+        if solver not in ('sqp', 'smo', 'primal'):
+            raise ValueError(f"Invalid solver: {solver}")
+        self.solver = solver
                 
         if kernel=='linear':
             self.kerf = Kernels.linear()
+            self.phi = Kernels.linear_phi()
         elif kernel=='poly':
             assert degree==2
             self.kerf = Kernels.poly(coef0)
+            self.phi = Kernels.poly_phi(coef0)
         else:
             raise ValueError(f"Invalid kernel: {kernel}")
     
     
     def fit(self, x: np.ndarray, y: np.ndarray, *args, **kwargs):
+        if self.solver == 'primal':
+            max_iter = self.max_iter if self.max_iter >= 0 else 1000
+            self.w_phi, self.bias, self.n_iter = solve_primal(self.phi(x), y, self.C, self.epsilon, self.tol, max_iter)
+            return
+        
         n = len(x)
         self.kp = kp = KernelProvider(x, self.kerf)
         p = np.concatenate([-y + self.epsilon, y + self.epsilon], axis=0)
         
         a = np.concatenate([np.ones(n), -np.ones(n)])
         
-        alpha = solve_qp(self.kp, p, self.C, a, np.zeros(2*n))
+        if self.solver == 'smo':
+            alpha, self.n_iter = solve_qp_smo(self.kp, p, self.C, a, np.zeros(2*n), self.tol, self.max_iter)
+        else:
+            alpha = solve_qp(self.kp, p, self.C, a, np.zeros(2*n))
     
         support_vectors_indices = []        
         coeffs = []
@@ -133,40 +255,59 @@ class MySVR(Model):
                 
         coeffs = np.array(coeffs)
         
-        def coeff_k_prod(coeffs, support_vectors_indices, x_index):
-            res = 0
-            for i in range(len(coeffs)):
-                res += coeffs[i] * self.kp.K(support_vectors_indices[i], x_index)
-            return res
-        
-        bias = 0
-        for i in range(n):
-            bias += y[i] - self.epsilon - coeff_k_prod(coeffs, support_vectors_indices, i)
-        bias /= n
+        bias = np.mean(y - self.epsilon - coeffs @ self.kp.gram[support_vectors_indices])
         
         self.coeffs = coeffs
         self.bias = bias
-        self.support_vectors = np.array([x[i] for i in support_vectors_indices])
+        self.support_vectors = x[support_vectors_indices]
+        self.w, self.W = self._primal_weights()
         
         #print(self.coeffs)
         #print(self.bias)
         #print(self.support_vectors)
     
+    def _primal_weights(self):
+        """
+            Collapses sum(coeffs[i] * k(sv[i], x)) into weights in the input space:
+                linear: x*w, poly2: x^t*W*x + 2*c0*x*w + c0^2*sum(coeffs), with w = sum(coeffs[i]*sv[i])
+            W is None for the linear kernel
+        """
+        # support_vectors is (n_sv, n_features) even without support vectors, then w = 0
+        sv = self.support_vectors
+        w = self.coeffs @ sv
+        if self.kernel == 'linear':
+            return w, None
+        return w, sv.T @ (self.coeffs[:, None] * sv)
+    
     def predict(self, x: np.ndarray, *args, **kwargs) -> np.ndarray: 
-        def coeff_k_prod(x):
-            res = 0
-            for i in range(len(self.coeffs)):
-                res += self.coeffs[i] * self.kp.K_new(self.support_vectors[i], x)
-            return res
-    
-        y = []
-        for i in range(len(x)):            
-            y.append(coeff_k_prod(x[i]) + self.bias)
-            S = 0
-            for j in range(len(self.coeffs)):
-                S += self.coeffs[j] * ((self.support_vectors[j] @ x[i]) ** 2)
-            
-        return np.array(y)
+        x = np.atleast_2d(x)
+        if self.solver == 'primal':
+            return self.phi(x) @ self.w_phi + self.bias
+        if self.kernel == 'linear':
+            return x @ self.w + self.bias
+        return np.sum((x @ self.W) * x, axis=1) + 2*self.coef0 * (x @ self.w) \
+            + self.coef0**2 * np.sum(self.coeffs) + self.bias
     
     def predict_one(self, X: np.ndarray, *args, **kwargs) -> np.ndarray:
-        return self.predict(X.reshape(1, -1))[0]        
\ No newline at end of file
+        return self.predict(X.reshape(1, -1))[0]
+
+
+def test_solve_qp_smo():
+    """ solve_qp_smo must reach the optimum found by scipy's SLSQP on a small SVR dual """
+    rng = np.random.default_rng(0)
+    n, C, epsilon = 25, 1.0, 0.1
+    x = rng.random((n, 3))
+    y = x @ rng.random(3) + 0.1 * rng.standard_normal(n)
+    kp = KernelProvider(x, Kernels.poly(1))
+    K = kp[:, :]
+    p = np.concatenate([-y + epsilon, y + epsilon], axis=0)
+    a = np.concatenate([np.ones(n), -np.ones(n)])
+    
+    fun = lambda alpha: 0.5 * alpha @ K @ alpha + p @ alpha
+    alpha, n_iter = solve_qp_smo(kp, p, C, a, np.zeros(2*n), tol=1e-8)
+    expected = minimize(fun, np.zeros(2*n), jac=lambda alpha: K @ alpha + p, method='SLSQP',
+                        bounds=[(0, C)] * (2*n), constraints=[{'type': 'eq', 'fun': lambda alpha: a @ alpha, 'jac': lambda alpha: a}],
+                        options={'ftol': 1e-12, 'maxiter': 1000})
+    print(f"smo: {fun(alpha)} after {n_iter} iterations, slsqp: {expected.fun}")
+    assert abs(a @ alpha) < 1e-10 and np.all((0 <= alpha) & (alpha <= C))
+    assert abs(fun(alpha) - expected.fun) < 1e-8
@@ -1,31 +1,57 @@
+import time
+from collections import OrderedDict
+
 import numpy as np
 
 from .model import Model
+from .svr import Kernels, solve_primal
 
 class KernelProvider:
-    def __init__(self, phi, x, u):
+    def __init__(self, phi, x, u, cache_size=200):
+        """ cache_size: memory budget of the kernel row cache, in MB """
         self.phi = phi
         self.x = x               
         self.u = u
         self.n = len(x)
-        self.cache_size=6000
-        self.phi_cache = [None]*self.cache_size
-    
-    def __get_phi(self, i):
-        if i>=self.cache_size:
-            return self.phi(self.x[i])        
-        if self.phi_cache[i] is None:
-            self.phi_cache[i] = self.phi(self.x[i])
-        return self.phi_cache[i]
-        
+        # explicit features of all samples, O(n * dim(phi)) instead of O(n^2)
+        self.phi_x = phi(x)
+        self.K_diag = np.einsum('ij,ij->i', self.phi_x, self.phi_x)
+        self.cache_size = cache_size
+        self.max_rows = max(2, int(cache_size * 2**20) // (self.n * self.phi_x.itemsize))
+        self.row_cache = OrderedDict()
         
     def K(self, i:int,j:int):         
         if i>=self.n: i-=self.n
         if j>=self.n: j-=self.n
-        return self.__get_phi(i) @ self.__get_phi(j)
+        return self.phi_x[i] @ self.phi_x[j]
         
     def Q(self, i:int,j:int): 
         return self.u[i]*self.u[j]*self.K(i,j)
+    
+    def K_row(self, i:int, idx=None):
+        """ Row i of the n x n kernel matrix, kept in an LRU cache
+            idx: only the entries idx of the row, computed without caching the row when they are
+                less than half of it
+        """
+        if i>=self.n: i-=self.n
+        row = self.row_cache.get(i)
+        if row is None:
+            if idx is not None and len(idx) < self.n // 2:
+                return self.phi_x[idx] @ self.phi_x[i]
+            row = self.phi_x @ self.phi_x[i]
+            self.row_cache[i] = row
+            if len(self.row_cache) > self.max_rows:
+                self.row_cache.popitem(last=False)
+        else:
+            self.row_cache.move_to_end(i)
+        return row if idx is None else row[idx]
+    
+    def Q_row(self, i:int, idx=None):
+        """ Row i of the L x L matrix Q, Q[i,j] = u[i]*u[j]*K(i,j), or only its entries idx """
+        if idx is None:
+            k = self.K_row(i)
+            return self.u[i] * self.u * np.concatenate([k, k])
+        return self.u[i] * self.u[idx] * self.K_row(i, idx % self.n)
 
 class SVR():
     def __init__(self,        
@@ -35,8 +61,12 @@ class SVR():
         max_iter = -1,
         kernel='linear',
         degree=2,
-        coef0=0
+        coef0=0,
+        cache_size=200,
+        shrinking=True,
+        solver='smo'
     ):
+        """ solver: 'smo' (dual, kernel rows) or 'primal' (L-BFGS on the explicit feature map) """
         self.epsilon = epsilon
         self.C = C
         self.phi = lambda x:x
@@ -45,24 +75,29 @@ class SVR():
         if kernel=="poly":
             if self.degree!=2:
                 raise NotImplementedError("Only degree 2 polynomial kernels are implemented")
-            def poly2_phi(x):
-                parts = [x*x]
-                pairs = np.array([[i,j] for i in range(x.shape[-1]) for j in range(x.shape[-1]) if i<j])                
-                if len(pairs)>0:
-                    parts.append(np.sqrt(2) * x[..., pairs[:,0]] * x[..., pairs[:, 1]],)
-                parts.append(np.sqrt(2*self.coef0) * x)
-                parts.append(np.ones(x.shape[:-1]+(1,))*self.coef0)
-                return np.concatenate(parts, axis=-1)
-            self.phi = poly2_phi
+            self.phi = Kernels.poly_phi(self.coef0)
         
+        if solver not in ('smo', 'primal'):
+            raise ValueError(f"Invalid solver: {solver}")
+        self.solver = solver
         self.tol = tol
-        self.max_iter = max_iter if max_iter>=0 else 10
+        self.cache_size = cache_size
+        self.shrinking = shrinking
+        if max_iter < 0:
+            max_iter = 10 if solver == 'smo' else 1000
+        self.max_iter = max_iter
    
    
     def fit(self, x: np.ndarray, y: np.ndarray, *args, **kwargs):
+        if self.solver == 'primal':
+            start_time = time.perf_counter()
+            self.w_alpha, self.w_b, self.n_iter = solve_primal(self.phi(x), y, self.C, self.epsilon, self.tol, self.max_iter)
+            self.fit_time = time.perf_counter() - start_time
+            return self
+        
         self.n = n = len(x)
         self.u = u = np.concatenate((np.ones(n), -np.ones(n)))    
-        self.kp = kp = KernelProvider(self.phi, x, u)        
+        self.kp = kp = KernelProvider(self.phi, x, u, self.cache_size)        
         self.L = L = 2 * n
         self.p = p = np.concatenate((
             self.epsilon * np.ones(n) - y,
@@ -72,42 +107,57 @@ class SVR():
         alpha = np.zeros((L,))
         
         #for i in range(n): alpha[i] = alpha[n+i] = np.random.rand()*self.C*1e-2
-       
-        Q = np.zeros((L,L))
-        for i in range(L):
-            for j in range(L):
-                Q[i,j] = self.kp.Q(i,j)
         
+        # gradient of the dual objective, Q*alpha + p, updated after every 2-variable step
+        G = p.copy()
+        # shrunk variables are left out of the selection and of the gradient updates,
+        # active_idx is None while all the variables are active
+        active = np.ones(L, dtype=bool)
+        active_idx = None
+        # shrink at least 10 times within max_iter, at most every 1000 iterations
+        shrink_interval = max(1, min(L, 1000, self.max_iter // 10))
+        shrink_counter = shrink_interval
+
         old_i, old_j = -1, -1
+        start_time = time.perf_counter()
+        self.n_iter = 0
         
-        for k in range(self.max_iter):
+        while self.n_iter < self.max_iter:
+            k = self.n_iter
+            self.n_iter += 1
             print(f"Iteration {k}")
-            i_up = self.I_up(alpha)
-            i_low = self.I_low(alpha)
+            
+            i_up = np.flatnonzero(self.I_up(alpha) & active)
+            i_low = np.flatnonzero(self.I_low(alpha) & active)
     
-            tmp_grads = np.array([-self.u[t]*self.grad_f(alpha, t) for t in range(L)])
-            m = np.max(tmp_grads[i_up])
-            M = np.min(tmp_grads[i_low])
+            tmp_grads = -self.u * G
+            m = np.max(tmp_grads[i_up], initial=-np.inf)
+            M = np.min(tmp_grads[i_low], initial=np.inf)
 
             if m-M<=self.epsilon:                
-                # if alpha(k) is a stationary point, stop
-                print("Stationary point found")
-                break            
+                if active.all():
+                    # if alpha(k) is a stationary point, stop
+                    print("Stationary point found")
+                    break
+                # stationary on the shrunk problem, check again on all the variables
+                # in a pass that is not counted towards max_iter
+                self.reconstruct_gradient(alpha, G, active)
+                active[:] = True
+                active_idx = None
+                self.n_iter -= 1
+                continue
 
             # Otherwise, find a two-element set B={i,j} by WSS
             i,j = self.wss1(alpha, tmp_grads, i_up, i_low, old_i, old_j)
             old_i, old_j = i, j
             B = np.array([i,j])
             print("B=", B)
-
-            # Define N = {1,...,L} \ B
-            N = np.array([ix for ix in range(self.L) if ix!=i and ix!=j])
             
-            # 2-variable subproblem parameters
+            # 2-variable subproblem parameters, P = p[B] + Q[B,N]*alpha[N] and D = -u[N]*alpha[N]
             Q = np.array([[self.kp.Q(i,i), self.kp.Q(i,j)],[ self.kp.Q(j,i), self.kp.Q(j,j)]])
-            P = p[B] + (self.compute_Q_BN(B,N) @ alpha[N])
+            P = G[B] - Q @ alpha[B]
             V = np.array([self.u[i], self.u[j]])
-            D = - self.u[N] @ alpha[N]
+            D = V @ alpha[B] - self.u @ alpha
             
             # aij = Kii + Kjj - 2*Kij
             aij = self.kp.K(i,i) + self.kp.K(j,j) - 2*self.kp.K(i,j)
@@ -121,15 +171,29 @@ class SVR():
             ai, aj = self.solve_q2_new(Q,P,V,D, alpha[i], alpha[j], self.u[i], self.u[j])            
             
             print(ai, aj)
+            if active_idx is None:
+                G += (ai - alpha[i]) * self.kp.Q_row(i) + (aj - alpha[j]) * self.kp.Q_row(j)
+            else:
+                G[active_idx] += (ai - alpha[i]) * self.kp.Q_row(i, active_idx) + (aj - alpha[j]) * self.kp.Q_row(j, active_idx)
             alpha[i], alpha[j] = ai, aj
             
             print("FOUND Aij = ", alpha[i], alpha[j])
             print(f"SOL {k} = ", alpha)
+            
+            if self.shrinking:
+                shrink_counter -= 1
+                if shrink_counter == 0:
+                    shrink_counter = shrink_interval
+                    active = self.shrink(alpha, G, active)
+                    active_idx = None if active.all() else np.flatnonzero(active)
 
-
+        if not active.all():
+            self.reconstruct_gradient(alpha, G, active)
+        self.fit_time = time.perf_counter() - start_time
+        self.G = G
         self.alpha0 = alpha        
 
-        self.w_alpha = np.atleast_1d(self.alpha0[:n]-self.alpha0[n:]) @ self.kp.phi(x)
+        self.w_alpha = np.atleast_1d(self.alpha0[:n]-self.alpha0[n:]) @ self.kp.phi_x
         
         print("A0=", self.w_alpha)
 
@@ -149,10 +213,10 @@ class SVR():
         return self
         
     def predict(self, X_set: np.ndarray, *args, **kwargs) -> np.ndarray:
-        return self.kp.phi(X_set) @ self.w_alpha + self.w_b
+        return self.phi(X_set) @ self.w_alpha + self.w_b
         
     def predict_one(self, X: np.ndarray, *args, **kwargs) -> np.ndarray:
-        return (self.kp.phi(X.reshape(1, -1)) @ self.w_alpha + self.w_b)[0]
+        return (self.phi(X.reshape(1, -1)) @ self.w_alpha + self.w_b)[0]
         
         
     def solve_q2_new(self, Q, P, V, D, aik, ajk, ui, uj):
@@ -187,65 +251,68 @@ class SVR():
         return alphai, alphaj        
         
     
-    def compute_Q_BN(self, B,N):                
-        q = np.zeros((2, self.L-2))
-        for x in range(len(B)):
-            for y in range(len(N)):
-                q[x,y] = self.kp.Q(B[x], N[y])
-        return q
-        
     def I_up(self, alpha):
-        return np.array([i for i in range(len(alpha)) if (alpha[i]<self.C and self.u[i]==1) or (alpha[i]>0 and self.u[i]==-1)])
+        return ((alpha<self.C) & (self.u==1)) | ((alpha>0) & (self.u==-1))
         
     def I_low(self, alpha):
-        return np.array([i for i in range(len(alpha)) if (alpha[i]<self.C and self.u[i]==-1) or (alpha[i]>0 and self.u[i]==1)])
+        return ((alpha<self.C) & (self.u==-1)) | ((alpha>0) & (self.u==1))
+    
+    def shrink(self, alpha, G, active):
+        """ 
+            Shrinking heuristic (LIBSVM): removes from the active set the bounded variables
+            whose gradient suggests they stay at their bound
+        """
+        u = self.u
+        up = self.I_up(alpha) & active
+        low = self.I_low(alpha) & active
+        
+        Gmax1 = np.max(-u[up] * G[up], initial=-np.inf)
+        Gmax2 = np.max(u[low] * G[low], initial=-np.inf)
+        
+        at_upper = alpha >= self.C
+        at_lower = alpha <= 0
+        stuck = (at_upper & (((u==1) & (-G > Gmax1)) | ((u==-1) & (-G > Gmax2)))) \
+              | (at_lower & (((u==1) & (G > Gmax2)) | ((u==-1) & (G > Gmax1))))
+        return active & ~stuck
+    
+    def reconstruct_gradient(self, alpha, G, active):
+        """ Recomputes G = Q*alpha + p for the shrunk variables, whose gradient is not updated
+            while they are inactive: (Q*alpha)[t] = u[t] * phi(x[t]) @ sum_s u[s]*alpha[s]*phi(x[s])
+        """
+        n = self.n
+        inactive = np.flatnonzero(~active)
+        w = (self.u[:n]*alpha[:n] + self.u[n:]*alpha[n:]) @ self.kp.phi_x
+        G[inactive] = self.p[inactive] + self.u[inactive] * (self.kp.phi_x[inactive % n] @ w)
         
     def grad_f(self, alpha, s):
         assert len(alpha) == 2*self.n
-        res = 0
-        for i in range(self.L):
-            res += self.kp.Q(s,i) * alpha[i]
-        res += self.p[s]
-        return res
+        return self.kp.Q_row(s) @ alpha + self.p[s]
 
     def wss1(self, alpha, tmp_grads, i_up, i_low, old_i, old_j):        
         assert self.p.shape == alpha.shape, f"{self.p.shape} != {alpha.shape}"
         
         L = self.L
+        K_diag = self.kp.K_diag
         
         i_sorted = i_up[np.argsort(tmp_grads[i_up])[::-1]]
         
         #i = i_up[np.argmax(tmp_grads[i_up])]
         for i in i_sorted:
-            a, b = np.zeros(L), np.zeros(L)
-            for t in range(L):
-                a[t] = self.kp.K(i,i)+self.kp.K(t,t)-2*self.kp.K(i,t)
-                if a[t]<=0: a[t] = self.tol
-                b[t] = tmp_grads[i] - tmp_grads[t]
-            
-            values = np.array([-b[t]*b[t]/a[t] for t in i_low if tmp_grads[t]<tmp_grads[i]])
-            j = i_low[np.argmin(values)]
-            
-            if i==j: continue
+            # second order selection: j minimizes -b^2/a over I_low, a = Kii + Ktt - 2*Kit
+            t = i_low[tmp_grads[i_low] < tmp_grads[i]]
+            if len(t) == 0: continue
+            a = K_diag[i % self.n] + K_diag[t % self.n] - 2*self.kp.K_row(i, t % self.n)
+            a[a<=0] = self.tol
+            b = tmp_grads[i] - tmp_grads[t]
+            j = t[np.argmin(-b*b/a)]
             
-            if (i==old_i and j==old_j): # We are stuck            
-                values = np.array([-b[t]*b[t]/a[t] for t in i_low if tmp_grads[t]<tmp_grads[i]])        
-                j = np.argmin(values) 
-                if j==old_j or j==i:
-                    j = np.random.randint(0, L)
-                    while i==j:
-                        j = np.random.randint(0, L)
-            else:
-                return i,j
+            if (i==old_i and j==old_j): # We are stuck, try the next i
+                continue
+            return i,j
         print("WSS FAILED?????????????????????????????????")
         
-        i = i_sorted[0]
+        i = j = i_sorted[0]
         while i==j:
             j = np.random.randint(0, L)
         
         return i,j
-        
-        
-                
-                
-        
\ No newline at end of file
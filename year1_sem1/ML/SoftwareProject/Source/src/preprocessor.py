@@ -1,6 +1,6 @@
-import datetime
 from abc import ABC, abstractmethod
 
+import numpy as np
 import pandas as pd
 
 
@@ -17,15 +17,16 @@ class DateAndTimePreprocessor(BaseProcessor):
     _TIMES_DIVISIONS = [6, 9, 12, 14, 17, 19, 22]
 
     @classmethod
-    def _drop_unoccupied_dates(cls, df: pd.DataFrame):
-        dates = set(df[cls._DATE_COLUMN])
-        unoccupied_dates = []
-        for date in dates:
-            room_occupancies = set(df[df[cls._DATE_COLUMN] == date][cls._TARGET_COLUMN])
-            if len(room_occupancies) == 1:
-                unoccupied_dates.append(date)
+    def _unoccupied_dates(cls, df: pd.DataFrame):
+        # dates on which the room occupancy never changes
+        occupancies = df.groupby(cls._DATE_COLUMN, sort=False, observed=True)[
+            cls._TARGET_COLUMN
+        ].nunique()
+        return occupancies.index[occupancies == 1]
 
-        return df[~df[cls._DATE_COLUMN].isin(unoccupied_dates)]
+    @classmethod
+    def _drop_unoccupied_dates(cls, df: pd.DataFrame):
+        return df[~df[cls._DATE_COLUMN].isin(cls._unoccupied_dates(df))]
 
     @classmethod
     def _preprocess_date(cls, date_column: pd.Series):
@@ -33,19 +34,17 @@ class DateAndTimePreprocessor(BaseProcessor):
         return date_column.map(date_mapping)
 
     @classmethod
-    def _categorize_time(cls, time: datetime.time):
-        for idx, time_division in enumerate(cls._TIMES_DIVISIONS, start=1):
-            if time.hour < time_division:
-                return idx
-        return len(cls._TIMES_DIVISIONS)
+    def _categorize_hours(cls, hours: np.ndarray):
+        # index of the first division above the hour, unparsed times (nan) go last
+        categories = np.searchsorted(cls._TIMES_DIVISIONS, hours, side="right") + 1
+        return np.minimum(categories, len(cls._TIMES_DIVISIONS))
 
     @classmethod
     def _preprocess_time(cls, time_column: pd.Series):
-        time_column = pd.to_datetime(
-            time_column, format="%H:%M:%S", errors="coerce"
-        ).dt.time
-
-        return time_column.apply(cls._categorize_time)
+        hours = pd.to_datetime(time_column, format="%H:%M:%S", errors="coerce").dt.hour
+        return pd.Series(
+            cls._categorize_hours(hours.to_numpy(dtype=float)), index=time_column.index
+        )
 
     @classmethod
     def process(cls, df: pd.DataFrame):
@@ -53,3 +52,31 @@ class DateAndTimePreprocessor(BaseProcessor):
         df[cls._DATE_COLUMN] = cls._preprocess_date(df[cls._DATE_COLUMN])
         df[cls._TIME_COLUMN] = cls._preprocess_time(df[cls._TIME_COLUMN])
         return df
+
+    @classmethod
+    def process_chunks(cls, path: str, chunksize: int = 100_000, **read_csv_kwargs):
+        """Same rows as process(pd.read_csv(path)), yielded in chunks of the CSV file.
+        A first pass over the Date and target columns finds the unoccupied dates and
+        the date numbering, so only one chunk of the full table is in memory at a time
+        """
+        pairs = pd.concat(
+            chunk.drop_duplicates()
+            for chunk in pd.read_csv(
+                path,
+                usecols=[cls._DATE_COLUMN, cls._TARGET_COLUMN],
+                chunksize=chunksize,
+                **read_csv_kwargs,
+            )
+        ).drop_duplicates()
+        unoccupied_dates = cls._unoccupied_dates(pairs)
+        dates = pairs[cls._DATE_COLUMN]
+        date_mapping = {
+            date: idx + 1
+            for idx, date in enumerate(dates[~dates.isin(unoccupied_dates)].unique())
+        }
+
+        for chunk in pd.read_csv(path, chunksize=chunksize, **read_csv_kwargs):
+            chunk = chunk[~chunk[cls._DATE_COLUMN].isin(unoccupied_dates)].copy()
+            chunk[cls._DATE_COLUMN] = chunk[cls._DATE_COLUMN].map(date_mapping)
+            chunk[cls._TIME_COLUMN] = cls._preprocess_time(chunk[cls._TIME_COLUMN])
+            yield chunk
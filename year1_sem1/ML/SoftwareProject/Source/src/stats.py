@@ -1,9 +1,26 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
 from typing import Literal
 
 import numpy as np
 import pandas as pd
 import scipy.stats as stats
 
+# DataFrame of a worker process, set once by _set_worker_dataframe
+_worker_data = {}
+
+
+def _set_worker_dataframe(df: pd.DataFrame):
+    _worker_data["df"] = df
+
+
+def _chi2_p_value_in_worker(column1: str, column2: str):
+    df = _worker_data["df"]
+    _, p_value = StatisticalTests.chi2_independence_between_columns(
+        df[column1], df[column2]
+    )
+    return p_value
+
 
 class StatisticalTests:
     _MAX_COLUMNS_CATEGORICAL_THRESHOLD = 20
@@ -28,33 +45,49 @@ class StatisticalTests:
         return rho, p_value
 
     @classmethod
-    def independence_matrix(cls, df: pd.DataFrame):
+    def _spearman_p_values(cls, ranks: np.ndarray):
+        """spearmanr p-values of every pair of columns, from their precomputed ranks"""
+        dof = len(ranks) - 2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rho = np.corrcoef(ranks, rowvar=False)
+            t = rho * np.sqrt((dof / ((rho + 1.0) * (1.0 - rho))).clip(0))
+        return 2 * stats.t.sf(np.abs(t), dof)
+
+    @classmethod
+    def _chi2_p_values(cls, df: pd.DataFrame, pairs: list, n_jobs: int | None = None):
+        n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs or 1
+        if min(n_jobs, len(pairs)) <= 1:
+            return [
+                cls.chi2_independence_between_columns(df[column1], df[column2])[1]
+                for column1, column2 in pairs
+            ]
+        # the DataFrame is sent once per worker, the tasks only carry column names
+        with ProcessPoolExecutor(
+            min(n_jobs, len(pairs)), initializer=_set_worker_dataframe, initargs=(df,)
+        ) as pool:
+            return list(pool.map(_chi2_p_value_in_worker, *zip(*pairs)))
+
+    @classmethod
+    def independence_matrix(cls, df: pd.DataFrame, n_jobs: int | None = None):
+        """n_jobs: worker processes for the chi2 tests (None or 1: in this process, -1: one per CPU)"""
         columns = df.columns
-        len_columns = len(columns)
-        matrix = np.zeros((len_columns, len_columns))
-
-        categorical_columns = {}
-
-        def is_categorical_memoized(column: str):
-            if column in categorical_columns:
-                return categorical_columns[column]
-            is_categorical = cls._is_categorical(df[column])
-            categorical_columns[i] = is_categorical
-            return is_categorical
-
-        for i in range(0, len_columns):
-            for j in range(i, len_columns):
-                if is_categorical_memoized(columns[i]) and is_categorical_memoized(
-                    columns[j]
-                ):
-                    matrix[i][j] = cls.chi2_independence_between_columns(
-                        df[columns[i]], df[columns[j]]
-                    )[1]
-                else:
-                    matrix[i][j] = cls.spearman_independence_between_columns(
-                        df[columns[i]], df[columns[j]]
-                    )[1]
-                matrix[j][i] = matrix[i][j]
+
+        # every column is scanned and ranked once
+        categorical = [cls._is_categorical(df[column]) for column in columns]
+        ranks = np.column_stack([stats.rankdata(df[column]) for column in columns])
+
+        matrix = cls._spearman_p_values(ranks)
+        chi2_pairs = [
+            (i, j)
+            for i in range(len(columns))
+            for j in range(i, len(columns))
+            if categorical[i] and categorical[j]
+        ]
+        p_values = cls._chi2_p_values(
+            df, [(columns[i], columns[j]) for i, j in chi2_pairs], n_jobs
+        )
+        for (i, j), p_value in zip(chi2_pairs, p_values):
+            matrix[i][j] = matrix[j][i] = p_value
 
         return pd.DataFrame(matrix, index=columns, columns=columns)
 
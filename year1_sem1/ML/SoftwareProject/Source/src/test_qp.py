@@ -0,0 +1,12 @@
+from models.QP import test_schur_step
+from models.svr import test_solve_qp_smo
+
+
+if __name__ == "__main__":
+    print("===== Test Schur complement step =====")
+    test_schur_step()
+    print("===== Test Schur complement step =====\n")
+
+    print("===== Test SMO QP solver =====")
+    test_solve_qp_smo()
+    print("===== Test SMO QP solver =====")